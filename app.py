@@ -3,19 +3,61 @@ from glob import glob
 from flask import Flask
 import sys
 from flask import request
-from flask import render_template, redirect, url_for
-import torchvision
+from flask import render_template, redirect, url_for, abort, Response
 import json
-from torch.utils.data import TensorDataset, DataLoader
-sys.path.append("./third_party/auto_LiRPA/third_party/auto_LiRPA")
-from third_party.auto_LiRPA.third_party.auto_LiRPA_verifiy import *
 import os
 import time
+from fi_store import FIStoreRegistry
+from heatmap_cache import HeatmapCache, max_level
+import http_cache
+from http_cache import AssetFingerprints
+from snapshot import SnapshotWriter
+from profiling import PROFILER, span, timed
+from jobs import JobQueue
+from result_store import ResultStore
+import payload
 
 
-app = Flask(__name__)
+JSON_PATH = 'third_party/fault_injection_json/FI_data.json'
+# network name -> FI_data.json, networks not listed here use JSON_PATH
+FI_JSON_PATHS = {}
+HEATMAP_CACHE_BYTES = 256 * 1024 * 1024
+# minimum time the dashboard keeps its loading state, waited out in the browser
+MIN_DISPLAY_MS = 0
+# set to a directory to keep a copy of every /data response, None disables it
+SNAPSHOT_DIR = None
+# time request stages for /metrics (also enabled by CYCLE_PROFILE=1)
+PROFILING = False
+# background audits submitted to /jobs
+JOB_STATE_PATH = 'keti2/jobs.json'
+JOB_OUT_PATH = './'
+JOB_DATA_ROOT = './data'
+JOB_WORKERS = 1
+JOB_LOADER_WORKERS = 0
+# cross-validation processes of a streaming job, not up to the client
+JOB_N_JOBS = 1
+# options a client may pass in "stream": (type, min, max), see dataclean.stream_label_errors
+JOB_STREAM_OPTIONS = {'chunk_size': (int, 64, 16384), 'pert_frac': (float, 0.0, 1.0),
+                      'pretrain_epochs': (int, 1, 50), 'cv_n_folds': (int, 2, 10), 'seed': (int, 0, 2 ** 32 - 1)}
+
+fi_stores = FIStoreRegistry(JSON_PATH, FI_JSON_PATHS)
+heatmaps = HeatmapCache(max_bytes=HEATMAP_CACHE_BYTES)
+snapshots = SnapshotWriter(SNAPSHOT_DIR) if SNAPSHOT_DIR else None
+assets = AssetFingerprints(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+if PROFILING:
+    PROFILER.enabled = True
+
+
+def run_audit(params):
+    """Job target: load the dataset and run the audit of ``params``."""
+    import dataclean
+    train_loader, test_loader = dataclean.make_loaders(params['dataset']['name'], JOB_DATA_ROOT,
+                                                       num_workers=JOB_LOADER_WORKERS)
+    return dataclean.run(train_loader, test_loader, dict(params, out_path=JOB_OUT_PATH))
+
+
+jobs = JobQueue(JOB_STATE_PATH, run_audit, max_workers=JOB_WORKERS)
 
-@app.route('/')
 def hello_world():
     return render_template("index.html")
 
@@ -23,73 +65,304 @@ def hello_world():
 
 
 
-def txt_to_list(path):
-    res = []
-    with open(path, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.strip("\n").split()
-            line = [int(item) for item in line]
-            res.append(line)
-        return res
+def load_heatmaps(item, level=0, max_cells=None):
+    """Heatmap arrays of one FI record, returns ``(level, arrays)``."""
+    if max_cells is not None:
+        level = heatmaps.level_for(item['heatmap_pristine'], max_cells)
+    else:
+        level = min(level, max_level(heatmaps.load(item['heatmap_pristine']).shape))
+    return level, {
+        'heatmap_pristine_list': heatmaps.load(item['heatmap_pristine'], level),
+        'heatmap_noise_list': heatmaps.load(item['heatmap_noise'], level),
+        'heatmap_noisedata_list': heatmaps.load(item['heatmap_noisedata'], level),
+    }
+
+
+def lookup_args(layer_name, interval):
+    """``(layer, interval)`` of a /data lookup, aborts with 400 when invalid."""
+    if not layer_name:
+        abort(400)
+    try:
+        interval = int(interval)
+    except (TypeError, ValueError):
+        abort(400)
+    return layer_name.lower(), interval
+
+
+def pyramid_args(resolution, max_cells):
+    """``(resolution, max_cells)`` as ints, aborts with 400 when invalid.
+
+    Levels past a heatmap's 1x1 level are clamped by the cache.
+    """
+    try:
+        resolution = int(resolution or 0)
+        max_cells = None if max_cells is None else int(max_cells)
+    except (TypeError, ValueError):
+        abort(400)
+    if resolution < 0 or (max_cells is not None and max_cells < 1):
+        abort(400)
+    return resolution, max_cells
+
 
-@app.route('/data', methods=['GET', 'POST'])
+# request headers a /data representation depends on, sent with 200 and 304 alike
+DATA_VARY = ('Accept', 'Accept-Encoding')
+
+
+def make_response_body(body, mimetype):
+    """Wrap an encoded body, compressing it if the client accepts it."""
+    resp = Response(body, mimetype=mimetype)
+    resp.vary.update(DATA_VARY)
+    encoding = payload.choose_encoding(request.accept_encodings)
+    if encoding is not None and len(body) >= payload.MIN_COMPRESS_BYTES:
+        with span('data.compress'):
+            resp.set_data(payload.compress(body, encoding))
+        resp.headers['Content-Encoding'] = encoding
+    return resp
+
+@timed('http.inject')
 def inject():
-    if (request.method == "GET"):
-        return render_template("data.html")
+    # GET with a layer is a lookup too, so browsers can cache and revalidate it
+    if (request.method == "GET" and "layer" not in request.args):
+        return render_template("data.html", min_display_ms=MIN_DISPLAY_MS)
     
     else:
         start2 = time.time()
-        net_name = request.form.get("net")
-        layer_name = request.form.get("layer").lower()
-        interval = int(request.form.get("interval"))
-        json_path = 'third_party/fault_injection_json/FI_data.json'
-        root_path = 'third_party/fault_injection_json'
-        with open(json_path,'r') as f:
-            dict = json.load(f)
+        net_name = request.values.get("net")
+        layer_name, interval = lookup_args(request.values.get("layer"), request.values.get("interval"))
         print(layer_name)
         print(interval)
-        pristine_acc = float(dict['pristine-acc'][:-1])
-        layers = dict['layers']
-        for layer in layers:
-            if(layer["name"] == layer_name):
-                layer_img = layer['layer']
-                intensity = layer['intensity']
-                for item in intensity:
-                    if(item['clock-cycles'] == interval):
-                        faulted_acc = item['faulted-acc']
-                        average_acc = item['average-acc']
-                        heatmap_pristine = os.path.join(root_path, item['heatmap_pristine'])
-                        heatmap_noise = os.path.join(root_path, item['heatmap_noise'])
-                        heatmap_noisedata =  os.path.join(root_path, item['heatmap_noisedata'])
-                        heatmap_pristine_list = txt_to_list(heatmap_pristine)
-                        heatmap_noise_list = txt_to_list(heatmap_noise)
-                        heatmap_noisedata_list = txt_to_list(heatmap_noisedata)
-
-                        with open('inject.json', 'w') as f:
-                            json.dump({
-                            'pristine_acc': pristine_acc,
-                            'faulted_acc': faulted_acc, 
-                            'average_acc':average_acc,
-                            'heatmap_pristine_list':heatmap_pristine_list,
-                            'heatmap_noise_list':heatmap_noise_list,
-                            'heatmap_noisedata_list':heatmap_noisedata_list}, f)
-
-                        end2 = time.time()
-                        responseTime = round(end2- start2 + 4, 4)
-
-                        time.sleep(3.5)
-                        return json.dumps({
-                            'pristine_acc': pristine_acc,
-                            'faulted_acc': faulted_acc, 
-                            'average_acc':average_acc,
-                            'heatmap_pristine_list':heatmap_pristine_list,
-                            'heatmap_noise_list':heatmap_noise_list,
-                            'heatmap_noisedata_list':heatmap_noisedata_list,
-                            'responseTime':responseTime
-                            })
+        with span('data.lookup'):
+            store = fi_stores.store(net_name)
+            item = store.get(layer_name, interval)
+        if item is None:
+            abort(404)
+        resolution, max_cells = pyramid_args(request.values.get('resolution'), request.values.get('max_cells'))
+        # JSON stays the default, binary only when asked for explicitly
+        fmt = request.values.get('format')
+        if fmt is None and request.accept_mimetypes.best_match(
+                [payload.JSON_MIMETYPE, payload.BINARY_MIMETYPE]) == payload.BINARY_MIMETYPE:
+            fmt = 'binary'
+        # the response is a function of these files, validate before loading anything
+        etag, last_modified = http_cache.file_validators(
+            [store.json_path] + [item[key] for key in ('heatmap_pristine', 'heatmap_noise', 'heatmap_noisedata')],
+            fmt, resolution, max_cells, payload.choose_encoding(request.accept_encodings))
+        if http_cache.not_modified(request, etag, last_modified):
+            resp = Response(status=304)
+            resp.vary.update(DATA_VARY)
+            return http_cache.set_validators(resp, etag, last_modified)
+        # full resolution unless the client asks for a pyramid level
+        # (resolution=<level>) or a cell budget (max_cells=<n>)
+        with span('data.heatmaps'):
+            level, arrays = load_heatmaps(item, resolution, max_cells)
+
+        end2 = time.time()
+        responseTime = round(end2 - start2, 4)
+
+        meta = {
+            'pristine_acc': item['pristine_acc'],
+            'faulted_acc': item['faulted_acc'],
+            'average_acc': item['average_acc'],
+            'responseTime': responseTime
+            }
+        if level:
+            meta['resolution'] = level
+        with span('data.encode'):
+            if fmt == 'binary':
+                body = payload.encode_binary(meta, arrays)
+                mimetype = payload.BINARY_MIMETYPE
+            else:
+                body = payload.encode_json(meta, arrays)
+                mimetype = payload.JSON_MIMETYPE
+            if snapshots is not None:
+                snapshots.submit((net_name, layer_name, interval), body)
+
+        return http_cache.set_validators(make_response_body(body, mimetype), etag, last_modified)
+
+
+@timed('http.inject_batch')
+def inject_batch():
+    """Many FI lookups in one round trip.
+
+    Request body (json)::
+
+        {"selectors": [{"net": "vgg", "layer": "conv1", "interval": 3}, ...],
+         "heatmaps": false, "resolution": 0, "max_cells": null}
+
+    A selector without ``layer`` or ``interval`` matches every layer /
+    interval of that network. Heatmaps are only included when asked for.
+    """
+    start = time.time()
+    query = request.get_json(force=True, silent=True)
+    if not isinstance(query, dict) or not isinstance(query.get('selectors'), list):
+        abort(400)
+    with_heatmaps = bool(query.get('heatmaps', False))
+    resolution, max_cells = pyramid_args(query.get('resolution'), query.get('max_cells'))
+    results = []
+    missing = []
+    for selector in query['selectors']:
+        if not isinstance(selector, dict):
+            abort(400)
+        net_name = selector.get('net')
+        layer_name = selector.get('layer')
+        interval = selector.get('interval')
+        try:
+            if layer_name is not None:
+                layer_name = str(layer_name).lower()
+            if interval is not None:
+                interval = int(interval)
+        except (TypeError, ValueError):
+            abort(400)
+        matches = fi_stores.store(net_name).select(layer_name, interval)
+        if not matches:
+            missing.append(selector)
+        for (name, cycles), item in matches:
+            res = {
+                'net': net_name,
+                'layer': name,
+                'interval': cycles,
+                'pristine_acc': item['pristine_acc'],
+                'faulted_acc': item['faulted_acc'],
+                'average_acc': item['average_acc'],
+            }
+            if with_heatmaps:
+                level, arrays = load_heatmaps(item, resolution, max_cells)
+                if level:
+                    res['resolution'] = level
+                for key, arr in arrays.items():
+                    res[key] = arr.tolist()
+            results.append(res)
+    body = json.dumps({
+        'results': results,
+        'missing': missing,
+        'responseTime': round(time.time() - start, 4),
+        }).encode('utf-8')
+    return make_response_body(body, payload.JSON_MIMETYPE)
                         
 
+def job_params(query):
+    """Validated run() params of a submission, None if malformed.
+
+    Output paths and n_jobs stay server-side (JOB_OUT_PATH, JOB_N_JOBS), the
+    client only picks the dataset and, for a full streaming audit, stream
+    options within the JOB_STREAM_OPTIONS ranges.
+    """
+    if not isinstance(query, dict):
+        return None
+    dataset = query.get('dataset')
+    name = dataset.get('name') if isinstance(dataset, dict) else dataset
+    if not isinstance(name, str) or name.upper() not in ('MNIST', 'CIFAR10'):
+        return None
+    params = {'dataset': {'name': name.upper()}}
+    stream = query.get('stream')
+    if stream:
+        opts = {}
+        if isinstance(stream, dict):
+            for key, value in stream.items():
+                if key not in JOB_STREAM_OPTIONS:
+                    return None
+                kind, lo, hi = JOB_STREAM_OPTIONS[key]
+                try:
+                    opts[key] = kind(value)
+                except (TypeError, ValueError):
+                    return None
+                if not lo <= opts[key] <= hi:
+                    return None
+        opts['n_jobs'] = JOB_N_JOBS
+        params['stream'] = opts
+    return params
+
+
+def submit_job():
+    """Queue an audit, body is run() params::
+
+        {"dataset": {"name": "CIFAR10"}, "stream": {"chunk_size": 2048}}
+
+    Returns 202 with the job record (``deduplicated`` when an identical job
+    already exists); training never runs on the request thread.
+    """
+    params = job_params(request.get_json(force=True, silent=True))
+    if params is None:
+        abort(400)
+    record, created = jobs.submit(params)
+    resp = Response(json.dumps(dict(record, deduplicated=not created)), status=202,
+                    mimetype=payload.JSON_MIMETYPE)
+    resp.headers['Location'] = url_for('job_status', job_id=record['id'])
+    return resp
+
+
+def job_status(job_id):
+    """Job record: status, current stage and the finished stages."""
+    record = jobs.get(job_id)
+    if record is None:
+        abort(404)
+    return Response(json.dumps(record), mimetype=payload.JSON_MIMETYPE)
+
+
+def job_result(job_id):
+    """Result of a finished job and the abnormal_data section of keti2.json."""
+    record = jobs.get(job_id)
+    if record is None:
+        abort(404)
+    if record['status'] != 'done':
+        return Response(json.dumps({'id': job_id, 'status': record['status'], 'error': record['error']}),
+                        status=409, mimetype=payload.JSON_MIMETYPE)
+    keti2 = ResultStore(os.path.join(JOB_OUT_PATH, 'keti2', 'keti2.json')).read()
+    body = {'id': job_id, 'result': record['result'], 'abnormal_data': keti2.get('abnormal_data')}
+    return Response(json.dumps(body), mimetype=payload.JSON_MIMETYPE)
+
+
+def metrics():
+    """Span aggregates in the Prometheus text format."""
+    return Response(PROFILER.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def static_url(filename):
+    """URL of a static file carrying its content hash, for templates."""
+    return url_for('static', filename=filename, v=assets.fingerprint(filename))
+
+
+def cache_static(resp):
+    """Far-future caching for static files requested by their current hash."""
+    if request.endpoint == 'static' and resp.status_code in (200, 304):
+        version = request.args.get('v')
+        if version and version == assets.fingerprint(request.view_args['filename']):
+            resp.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(http_cache.IMMUTABLE_MAX_AGE)
+    return resp
+
+
+def preload(heatmap_files=False):
+    """Load the FI indexes (and optionally map every heatmap) up front.
+
+    Called before the server forks its workers so they share the loaded
+    data copy-on-write instead of each building their own.
+    """
+    fi_stores.load_all()
+    if heatmap_files:
+        for store in fi_stores.stores():
+            for _, item in store.items():
+                load_heatmaps(item)
+
+
+def create_app(preload_data=False, preload_heatmaps=False):
+    """App factory, see wsgi.py / asgi.py for the production entry points."""
+    app = Flask(__name__)
+    app.add_url_rule('/', 'hello_world', hello_world)
+    app.add_url_rule('/data', 'inject', inject, methods=['GET', 'POST'])
+    app.add_url_rule('/data/batch', 'inject_batch', inject_batch, methods=['POST'])
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    app.add_url_rule('/jobs', 'submit_job', submit_job, methods=['POST'])
+    app.add_url_rule('/jobs/<job_id>', 'job_status', job_status)
+    app.add_url_rule('/jobs/<job_id>/result', 'job_result', job_result)
+    app.add_template_global(static_url)
+    app.after_request(cache_static)
+    if preload_data:
+        preload(heatmap_files=preload_heatmaps)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
-    
+    # 开发服务器, 生产环境见 wsgi.py
+    preload()
     app.run(host='0.0.0.0', port=10080, threaded=True)
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""生产部署入口 -- ASGI entry point.
+
+    pip install asgiref uvicorn
+    uvicorn --workers 4 --host 0.0.0.0 --port 10080 asgi:application
+
+asgiref is not a dependency of the app itself, only of this module. The
+Flask app stays synchronous: WsgiToAsgi runs each request on a thread, so
+this is for deployments standardized on an ASGI server, not a faster path.
+Unlike gunicorn --preload, uvicorn imports the app in every worker, so each
+worker loads its own FI index; heatmap sidecars are memory-mapped and still
+shared through the page cache.
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app
+
+application = WsgiToAsgi(create_app(preload_data=True, preload_heatmaps=True))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""检测结果缓存 -- content-addressed cache of cross-validated psx.
+
+An entry is a directory named by the sha256 of everything the result
+depends on (data fingerprint, noisy labels, model class, hyperparameters,
+fold count) and holds ``psx.npy``, ``confident_joint.npy`` and the
+pre-trained ``weights.pt``.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+
+def fingerprint(arr):
+    """sha256 of an array's dtype, shape and bytes."""
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha256()
+    h.update(str(arr.dtype).encode('utf-8'))
+    h.update(str(arr.shape).encode('utf-8'))
+    h.update(memoryview(arr).cast('B'))
+    return h.hexdigest()
+
+
+def fingerprint_state(state_dict):
+    """sha256 of a torch state dict (parameter names and values)."""
+    h = hashlib.sha256()
+    for name, tensor in state_dict.items():
+        h.update(name.encode('utf-8'))
+        h.update(fingerprint(tensor.detach().cpu().numpy()).encode('ascii'))
+    return h.hexdigest()
+
+
+class AuditCache(object):
+    """Directory of cached audit results with LRU eviction by total size.
+
+    Parameters
+    ----------
+    root: str
+        cache directory
+    max_bytes: int
+        total size kept on disk, least recently used entries go first
+    """
+
+    PSX = 'psx.npy'
+    JOINT = 'confident_joint.npy'
+    WEIGHTS = 'weights.pt'
+
+    def __init__(self, root='.audit_cache', max_bytes=2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(**parts):
+        """Cache key of the keyword arguments (json-serializable values)."""
+        blob = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """Return ``{'psx', 'confident_joint', 'weights'}`` or None.
+
+        psx is memory-mapped, weights is the path of the state dict.
+        """
+        path = self.path(key)
+        try:
+            psx = np.load(os.path.join(path, self.PSX), mmap_mode='r')
+            joint = np.load(os.path.join(path, self.JOINT))
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):
+            return None
+        return {'psx': psx, 'confident_joint': joint, 'weights': os.path.join(path, self.WEIGHTS)}
+
+    def put(self, key, psx, confident_joint, state_dict=None):
+        """Store an entry atomically, then evict down to max_bytes."""
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            np.save(os.path.join(tmp, self.PSX), np.asarray(psx))
+            np.save(os.path.join(tmp, self.JOINT), np.asarray(confident_joint))
+            if state_dict is not None:
+                import torch
+                torch.save(state_dict, os.path.join(tmp, self.WEIGHTS))
+            with self._lock:
+                if os.path.isdir(self.path(key)):
+                    shutil.rmtree(tmp)
+                    return
+                try:
+                    os.rename(tmp, self.path(key))
+                except OSError:
+                    if not os.path.isdir(self.path(key)):
+                        raise
+                    # another process stored the same key first, keep its entry
+                    shutil.rmtree(tmp)
+                    return
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict()
+
+    def entries(self):
+        """``[(last used, size, key)]`` of the stored entries."""
+        out = []
+        for name in os.listdir(self.root):
+            path = self.path(name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            out.append((os.path.getmtime(path), size, name))
+        return out
+
+    def evict(self):
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(self.path(name), ignore_errors=True)
+                total -= size
@@ -0,0 +1,720 @@
+# -*- coding: utf-8 -*-
+"""性能基准 -- micro benchmarks for the dashboard and audit code paths.
+
+    python benchmark.py lookup --layers 20 --intervals 50
+    python benchmark.py heatmap --size 512
+    python benchmark.py payload --size 512
+    python benchmark.py load --url http://127.0.0.1:10080 --layer conv1 --interval 3
+    python benchmark.py startup --max-seconds 2 --max-rss-mb 300
+    python benchmark.py predict --size 10000 --folds 2 5 10
+    python benchmark.py fit --size 10000 --subsets 64 640 6400
+    python benchmark.py postprocess --sizes 64 10000 1000000
+    python benchmark.py pert --size 1000000 --fractions 0.01 0.5 0.9
+    python benchmark.py keti-stress --writers 16 --updates 50
+    python benchmark.py loader --dataset CIFAR10 --root ./data --workers 0 2 4
+    python benchmark.py spans --n 200000
+    python benchmark.py warmstart --size 2000 --pretrain-epochs 10
+    python benchmark.py inference --model CIFAR10 --size 2048 --batch-size 256
+    python benchmark.py revalidate --layers 4 --intervals 8 --lookups 5
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from fi_store import FIStore
+from heatmap_cache import HeatmapCache
+import payload
+
+
+def make_fi_fixture(root, n_layers=20, n_intervals=50, heatmap_shape=(32, 32), seed=0):
+    """Write a synthetic FI_data.json (plus heatmap txt files) under root."""
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    layers = []
+    for l in range(n_layers):
+        intensity = []
+        for c in range(n_intervals):
+            item = {'clock-cycles': c, 'faulted-acc': rng.random(), 'average-acc': rng.random()}
+            for key in ('heatmap_pristine', 'heatmap_noise', 'heatmap_noisedata'):
+                fn = '{}_{}_{}.txt'.format(key, l, c)
+                with open(os.path.join(root, fn), 'w') as f:
+                    for _ in range(heatmap_shape[0]):
+                        f.write(' '.join(str(rng.randint(0, 255)) for _ in range(heatmap_shape[1])) + '\n')
+                item[key] = fn
+            intensity.append(item)
+        layers.append({'name': 'conv{}'.format(l), 'layer': 'conv{}.png'.format(l), 'intensity': intensity})
+    json_path = os.path.join(root, 'FI_data.json')
+    with open(json_path, 'w') as f:
+        json.dump({'pristine-acc': '91.5%', 'layers': layers}, f)
+    return json_path
+
+
+def legacy_lookup(json_path, layer_name, interval):
+    """The original /data lookup: parse the whole file and scan it."""
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    for layer in data['layers']:
+        if layer['name'] == layer_name:
+            for item in layer['intensity']:
+                if item['clock-cycles'] == interval:
+                    return item
+
+
+def timeit(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+def bench_lookup(args):
+    with tempfile.TemporaryDirectory() as root:
+        json_path = make_fi_fixture(root, args.layers, args.intervals, heatmap_shape=(1, 1))
+        keys = [('conv{}'.format(random.randrange(args.layers)), random.randrange(args.intervals))
+                for _ in range(args.repeat)]
+        it = iter(keys)
+        legacy = timeit(lambda: legacy_lookup(json_path, *next(it)), args.repeat)
+        store = FIStore(json_path)
+        store.load()
+        it = iter(keys)
+        indexed = timeit(lambda: store.get(*next(it)), args.repeat)
+        print('lookup ({} layers x {} intervals)'.format(args.layers, args.intervals))
+        print('  legacy scan : {:.4f} ms/request'.format(legacy))
+        print('  FIStore     : {:.4f} ms/request'.format(indexed))
+
+
+def legacy_txt_to_list(path):
+    res = []
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            res.append([int(item) for item in line.strip("\n").split()])
+    return res
+
+
+def bench_heatmap(args):
+    with tempfile.TemporaryDirectory() as root:
+        make_fi_fixture(root, 1, 1, heatmap_shape=(args.size, args.size))
+        path = os.path.join(root, 'heatmap_pristine_0_0.txt')
+        legacy = timeit(lambda: legacy_txt_to_list(path), args.repeat)
+        t0 = time.perf_counter()
+        HeatmapCache(max_bytes=0).load(path)
+        first = (time.perf_counter() - t0) * 1000
+        sidecar = timeit(lambda: HeatmapCache(max_bytes=0).load(path), args.repeat)
+        cache = HeatmapCache()
+        cache.load(path)
+        warm = timeit(lambda: cache.load(path), args.repeat)
+        print('heatmap {0}x{0}'.format(args.size))
+        print('  txt_to_list (legacy) : {:.4f} ms'.format(legacy))
+        print('  first read + sidecar : {:.4f} ms'.format(first))
+        print('  mmap sidecar         : {:.4f} ms'.format(sidecar))
+        print('  LRU hit              : {:.4f} ms'.format(warm))
+
+
+def bench_payload(args):
+    import numpy as np
+    rng = np.random.RandomState(0)
+    arrays = {name: rng.randint(0, 256, size=(args.size, args.size)).astype(np.uint8)
+              for name in ('heatmap_pristine_list', 'heatmap_noise_list', 'heatmap_noisedata_list')}
+    meta = {'pristine_acc': 91.5, 'faulted_acc': 0.5, 'average_acc': 0.5, 'responseTime': 0.0}
+    variants = [('json', payload.encode_json, None), ('json+gzip', payload.encode_json, 'gzip'),
+                ('binary', payload.encode_binary, None), ('binary+gzip', payload.encode_binary, 'gzip')]
+    if payload.brotli is not None:
+        variants.insert(2, ('json+br', payload.encode_json, 'br'))
+    print('payload 3 x {0}x{0} heatmaps'.format(args.size))
+    for name, encode, encoding in variants:
+        body = payload.compress(encode(meta, arrays), encoding)
+        ms = timeit(lambda: payload.compress(encode(meta, arrays), encoding), args.repeat)
+        print('  {:<12}: {:>10} bytes  {:.3f} ms'.format(name, len(body), ms))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def load_test(url, data=None, requests=500, concurrency=8):
+    """Fire ``requests`` requests with ``concurrency`` threads, returns stats in ms."""
+    body = urlencode(data).encode('utf-8') if data is not None else None
+
+    def one(_):
+        t0 = time.perf_counter()
+        try:
+            with urlopen(Request(url, data=body)) as resp:
+                resp.read()
+            ok = True
+        except HTTPError as e:
+            e.read()
+            ok = False
+        return (time.perf_counter() - t0) * 1000, ok
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - t0
+    latencies = [ms for ms, _ in results]
+    return {'rps': requests / elapsed, 'p50': percentile(latencies, 50), 'p99': percentile(latencies, 99),
+            'errors': sum(1 for _, ok in results if not ok)}
+
+
+def bench_load(args):
+    base = args.url.rstrip('/')
+    targets = [('GET /', base + '/', None),
+               ('POST /data', base + '/data', {'net': args.net, 'layer': args.layer, 'interval': args.interval})]
+    for name, url, data in targets:
+        stats = load_test(url, data, args.requests, args.concurrency)
+        print('{:<11} {:8.1f} req/s  p50 {:8.2f} ms  p99 {:8.2f} ms  errors {}'.format(
+            name, stats['rps'], stats['p50'], stats['p99'], stats['errors']))
+
+
+class SyntheticImages(object):
+    """torchvision-style dataset (``data``/``targets``) of random images.
+
+    With ``signal > 0`` every image is blended with a fixed per-class
+    pattern, so a model can actually learn the labels.
+    """
+
+    def __init__(self, n, shape=(28, 28), n_classes=10, seed=0, signal=0.0):
+        import numpy as np
+        rng = np.random.RandomState(seed)
+        self.data = rng.randint(0, 256, size=(n,) + tuple(shape)).astype(np.uint8)
+        self.targets = rng.randint(0, n_classes, size=n).tolist()
+        if signal:
+            patterns = rng.randint(0, 256, size=(n_classes,) + tuple(shape))
+            blend = (1 - signal) * self.data + signal * patterns[self.targets]
+            self.data = blend.astype(np.uint8)
+
+    def __getitem__(self, i):
+        import torch
+        img = torch.from_numpy(self.data[i]).float().div_(255)
+        img = img.unsqueeze(0) if img.dim() == 2 else img.permute(2, 0, 1)
+        return img, self.targets[i]
+
+    def __len__(self):
+        return len(self.data)
+
+
+def legacy_predict_proba(cnn, idx):
+    """CNN.predict_proba before subset views: deep-copy, then fancy-index."""
+    import copy
+    import numpy as np
+    import torch
+    dataset = copy.deepcopy(cnn.test_loader.dataset)
+    dataset.data = np.array(dataset.data)[idx]
+    dataset.targets = np.array(dataset.targets)[idx]
+    loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=cnn.test_batch_size)
+    cnn.model.eval()
+    outputs = []
+    with torch.no_grad():
+        for data, _ in loader:
+            outputs.append(cnn.model(data))
+    return np.exp(torch.cat(outputs, dim=0).numpy())
+
+
+def bench_predict(args):
+    import numpy as np
+    from torch.utils.data import DataLoader
+    from dataclean import CNN
+
+    dataset = SyntheticImages(args.size)
+    loader = DataLoader(dataset, batch_size=64)
+    cnn = CNN(test_loader=loader, train_loader=loader, test_size=args.size,
+              test_batch_size=args.batch_size, log_interval=None, dataset='MNIST')
+    print('predict_proba on {} samples, batch {}'.format(args.size, args.batch_size))
+    for k in args.folds:
+        folds = np.array_split(np.random.RandomState(0).permutation(args.size), k)
+        for name, fn in (('deepcopy', legacy_predict_proba), ('subset', CNN.predict_proba)):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            for idx in folds:
+                fn(cnn, idx)
+            ms = (time.perf_counter() - t0) * 1000
+            peak = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+            tracemalloc.stop()
+            print('  folds={:<3} {:<9} {:9.1f} ms  peak {:8.1f} MB'.format(k, name, ms, peak))
+
+
+def bench_fit(args):
+    import numpy as np
+    import torch.nn.functional as F
+    import torch.optim as optim
+    from torch.utils.data import DataLoader
+    from dataclean import CNN
+
+    dataset = SyntheticImages(args.size)
+    loader = DataLoader(dataset, batch_size=64)
+    cnn = CNN(test_loader=loader, train_loader=loader, test_size=args.size,
+              epochs=1, log_interval=None, dataset='MNIST')
+    print('CNN.fit, 1 epoch, dataset of {} samples'.format(args.size))
+
+    # the old fit: one pass over the whole train_loader, whatever train_idx is
+    optimizer = optim.SGD(cnn.model.parameters(), lr=cnn.lr, momentum=cnn.momentum)
+    t0 = time.perf_counter()
+    cnn.model.train()
+    for data, target in loader:
+        optimizer.zero_grad()
+        F.nll_loss(cnn.model(data), target.long()).backward()
+        optimizer.step()
+    print('  full loader pass        {:9.1f} ms'.format((time.perf_counter() - t0) * 1000))
+
+    rng = np.random.RandomState(0)
+    for n in args.subsets:
+        idx = rng.choice(args.size, n, replace=False)
+        labels = np.asarray(dataset.targets)[idx]
+        t0 = time.perf_counter()
+        cnn.fit(idx, labels)
+        cold = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        cnn.fit(idx, labels)
+        warm = (time.perf_counter() - t0) * 1000
+        print('  subset {:<7} cold {:9.1f} ms  cached {:9.1f} ms'.format(n, cold, warm))
+
+
+def legacy_postprocess(psx, y_test, y_ori, red_box_idxs, max_images):
+    """run_cleanlab's post-processing before vectorization."""
+    import numpy as np
+    noise_idx = np.asarray([i in red_box_idxs for i in range(len(y_test))])
+    pred = np.argmax(psx, axis=1)
+    ordered_noise_idx = np.argsort(np.asarray([psx[i][j] for i, j in enumerate(y_test)])[noise_idx])
+    prob_given = np.asarray([psx[i][j] for i, j in enumerate(y_test)])[noise_idx][ordered_noise_idx][:max_images]
+    prob_pred = np.asarray([psx[i][j] for i, j in enumerate(pred)])[noise_idx][ordered_noise_idx][:max_images]
+    img_idx = np.arange(len(noise_idx))[noise_idx][ordered_noise_idx][:max_images]
+    wr_matrix = np.zeros((10, 10))
+    for i in range(len(y_test)):
+        wr_matrix[pred[i], y_ori[i]] += 1
+    return img_idx, prob_given, prob_pred, wr_matrix
+
+
+def vectorized_postprocess(psx, y_test, y_ori, red_box_idxs, max_images):
+    import numpy as np
+    from dataclean import confusion_counts, index_mask, rank_label_errors
+    noise_idx = index_mask(len(y_test), red_box_idxs)
+    pred = np.argmax(psx, axis=1)
+    img_idx, prob_given, prob_pred, _, _ = rank_label_errors(psx, y_test, pred, noise_idx, max_images)
+    return img_idx, prob_given, prob_pred, confusion_counts(pred, y_ori, psx.shape[1])
+
+
+def bench_postprocess(args):
+    import numpy as np
+    import dataclean  # noqa: F401, keep the torch import out of the timings
+    rng = np.random.RandomState(0)
+    print('run_cleanlab post-processing (PERT_NUM = N / 4)')
+    for n in args.sizes:
+        psx = rng.dirichlet(np.ones(10), size=n)
+        y_ori = rng.randint(0, 10, size=n)
+        y_test = y_ori.copy()
+        red_box_idxs = rng.choice(n, max(1, n // 4), replace=False).tolist()
+        y_test[red_box_idxs] = (y_test[red_box_idxs] + 1) % 10
+        t0 = time.perf_counter()
+        new = vectorized_postprocess(psx, y_test, y_ori, red_box_idxs, 32)
+        fast = (time.perf_counter() - t0) * 1000
+        if n <= args.legacy_max:
+            t0 = time.perf_counter()
+            old = legacy_postprocess(psx, y_test, y_ori, red_box_idxs, 32)
+            slow = '{:10.1f} ms'.format((time.perf_counter() - t0) * 1000)
+            assert all(np.array_equal(a, b) for a, b in zip(old, new))
+        else:
+            slow = '   skipped'
+        print('  N={:<8} loops {}  vectorized {:8.2f} ms'.format(n, slow, fast))
+
+
+def legacy_get_pert(PERT_NUM, y_ori, y_pert):
+    """get_pert before vectorization: rejection sampling on the global random."""
+    pert_list = []
+    for i in range(PERT_NUM):
+        rand_num = random.randint(0, 9)
+        data_index = random.randint(0, len(y_pert) - 1)
+        while y_ori[data_index] != y_pert[data_index]:
+            data_index = random.randint(0, len(y_pert) - 1)
+        pert_list.append(data_index)
+        while rand_num == y_pert[data_index]:
+            rand_num = random.randint(0, 9)
+        y_pert[data_index] = rand_num
+    return y_pert, pert_list
+
+
+def bench_pert(args):
+    import numpy as np
+    from dataclean import get_pert
+    y = np.random.RandomState(0).randint(0, 10, size=args.size)
+    print('label perturbation, N={}'.format(args.size))
+    for frac in args.fractions:
+        k = int(frac * args.size)
+        if k <= args.legacy_max:
+            t0 = time.perf_counter()
+            legacy_get_pert(k, y, y.copy())
+            slow = '{:10.1f} ms'.format((time.perf_counter() - t0) * 1000)
+        else:
+            slow = '   skipped'
+        t0 = time.perf_counter()
+        get_pert(k, y, y.copy(), rng=np.random.default_rng(0))
+        fast = (time.perf_counter() - t0) * 1000
+        print('  PERT_NUM={:<9} rejection {}  vectorized {:8.2f} ms'.format(k, slow, fast))
+
+
+def _keti_writer(json_path, writer, updates):
+    from result_store import ResultStore
+    store = ResultStore(json_path)
+    for i in range(updates):
+        store.set(('section{}'.format(writer % 4), 'writer{}'.format(writer)), i)
+        store.read()  # readers must always see a complete file
+
+
+def bench_keti_stress(args):
+    from result_store import ResultStore
+    with tempfile.TemporaryDirectory() as root:
+        json_path = os.path.join(root, 'keti2.json')
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keti2', 'keti2.json')) as f:
+            original = json.load(f)
+        with open(json_path, 'w') as f:
+            json.dump(original, f)
+        t0 = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.writers) as pool:
+            list(pool.map(_keti_writer, [json_path] * args.writers, range(args.writers),
+                          [args.updates] * args.writers))
+        elapsed = time.perf_counter() - t0
+        data = ResultStore(json_path).read()
+        lost = [w for w in range(args.writers)
+                if data.get('section{}'.format(w % 4), {}).get('writer{}'.format(w)) != args.updates - 1]
+        untouched = all(data[k] == v for k, v in original.items())
+        print('{} writers x {} updates: {:.1f} updates/s, lost {}, original sections intact: {}'.format(
+            args.writers, args.updates, args.writers * args.updates / elapsed, len(lost), untouched))
+        if lost or not untouched:
+            sys.exit(1)
+
+
+def _images_per_second(loader, max_batches):
+    n = 0
+    t0 = time.perf_counter()
+    for i, (x, _) in enumerate(loader):
+        n += len(x)
+        if i + 1 >= max_batches:
+            break
+    return n / (time.perf_counter() - t0)
+
+
+def bench_loader(args):
+    import torchvision
+    from torch.utils.data import DataLoader
+    from dataset_cache import CachedImageDataset, make_loader
+
+    base = getattr(torchvision.datasets, args.dataset)(args.root, train=True, download=True,
+                                                      transform=torchvision.transforms.ToTensor())
+    cached = CachedImageDataset(args.dataset, args.root, train=True)
+    print('{} train loader, batch {}'.format(args.dataset, args.batch_size))
+    for workers in args.workers:
+        old = DataLoader(base, batch_size=args.batch_size, shuffle=True, num_workers=workers)
+        new = make_loader(cached, batch_size=args.batch_size, shuffle=True, num_workers=workers)
+        print('  workers={:<2} ToTensor {:10.0f} img/s   cached {:10.0f} img/s'.format(
+            workers, _images_per_second(old, args.batches), _images_per_second(new, args.batches)))
+
+
+def bench_spans(args):
+    from profiling import Profiler
+
+    def loop(prof):
+        span = prof.span
+        t0 = time.perf_counter()
+        for _ in range(args.n):
+            with span('stage'):
+                pass
+        return (time.perf_counter() - t0) / args.n * 1e9
+
+    print('span enter+exit, {} iterations'.format(args.n))
+    print('  disabled {:8.0f} ns'.format(loop(Profiler(enabled=False))))
+    print('  enabled  {:8.0f} ns'.format(loop(Profiler(enabled=True))))
+
+
+def bench_warmstart(args):
+    import numpy as np
+    from sklearn.base import clone
+    from sklearn.model_selection import StratifiedKFold
+    from torch.utils.data import DataLoader
+    from dataclean import CNN
+
+    dataset = SyntheticImages(args.size, signal=args.signal)
+    labels = np.asarray(dataset.targets)
+    loader = DataLoader(dataset, batch_size=64)
+    X = np.arange(args.size)
+    cnn = CNN(test_loader=loader, train_loader=loader, test_size=args.size,
+              epochs=args.pretrain_epochs, log_interval=None, lr=args.lr, dataset='MNIST')
+    cnn.fit(X, labels)
+    pretrained = {k: v.clone() for k, v in cnn.model.state_dict().items()}
+    splits = list(StratifiedKFold(n_splits=args.folds, shuffle=True, random_state=0).split(X, labels))
+
+    # sklearn.clone rebuilds the network: without `pretrained` a fold starts cold
+    paths = [
+        ('cold, 1 epoch', dict(epochs=1, pretrained=None)),
+        ('cold, {} epochs'.format(args.pretrain_epochs + 1), dict(epochs=args.pretrain_epochs + 1, pretrained=None)),
+        ('warm, 1 epoch', dict(epochs=1, pretrained=pretrained)),
+    ]
+    print('{}-fold holdout accuracy, {} samples, pre-trained {} epochs'.format(
+        args.folds, args.size, args.pretrain_epochs))
+    for name, params in paths:
+        accs = []
+        t0 = time.perf_counter()
+        for train_idx, holdout_idx in splits:
+            fold = clone(cnn.set_params(**params))
+            fold.fit(X[train_idx], labels[train_idx])
+            accs.append(np.mean(fold.predict(X[holdout_idx]) == labels[holdout_idx]))
+        dt = (time.perf_counter() - t0) / args.folds * 1000
+        print('  {:<16} acc {:.3f} +- {:.3f}   {:8.1f} ms/fold'.format(name, np.mean(accs), np.std(accs), dt))
+
+
+def bench_inference(args):
+    import torch
+    import inference
+    from dataclean import CIFAR10_CNN, MNIST_CNN, _inference_mode
+
+    torch.manual_seed(0)
+    if args.model == 'CIFAR10':
+        model, shape = CIFAR10_CNN(), (3, 32, 32)
+        # untrained BatchNorm is the identity, give it something to fold
+        for name, mod in model.named_modules():
+            if isinstance(mod, torch.nn.BatchNorm2d):
+                mod.running_mean.uniform_(-0.5, 0.5)
+                mod.running_var.uniform_(0.5, 2.0)
+                mod.weight.data.uniform_(0.5, 1.5)
+                mod.bias.data.uniform_(-0.2, 0.2)
+    else:
+        model, shape = MNIST_CNN(), (1, 28, 28)
+    model.eval()
+    x = torch.rand((args.size,) + shape)
+    batches = x.split(args.batch_size)
+
+    def run(fn, prepare=lambda b: b):
+        with _inference_mode():
+            fn(prepare(batches[0]))  # warm-up
+            t0 = time.perf_counter()
+            out = torch.cat([fn(prepare(b)) for b in batches])
+        return args.size / (time.perf_counter() - t0), out.exp()
+
+    print('{} inference, {} images, batch {}, {} threads'.format(
+        args.model, args.size, args.batch_size, torch.get_num_threads()))
+    base_rate, base = run(model)
+    print('  {:<8} {:9.0f} img/s'.format('eager', base_rate))
+    cl = lambda b: b.contiguous(memory_format=torch.channels_last)
+    for quantize in (None, 'dynamic', 'static'):
+        exported = inference.export(model, batches[0], quantize=quantize)
+        rate, probs = run(exported, cl)
+        print('  {:<8} {:9.0f} img/s  x{:4.2f}  max |dp| {:.2e}  argmax agree {:.4f}'.format(
+            quantize or 'fused', rate, rate / base_rate, (probs - base).abs().max().item(),
+            (probs.argmax(1) == base.argmax(1)).float().mean().item()))
+
+
+class _BrowserCache(object):
+    """Just enough of a browser HTTP cache to count what goes over the wire."""
+
+    def __init__(self, client):
+        self.client = client
+        self.entries = {}
+        self.requests = 0
+        self.bytes = 0
+
+    def get(self, url, method='GET', data=None):
+        entry = self.entries.get(url) if method == 'GET' else None
+        if entry is not None and 'immutable' in entry.headers.get('Cache-Control', ''):
+            return entry  # fresh, no request at all
+        headers = {'Accept-Encoding': 'gzip'}
+        if entry is not None and entry.headers.get('ETag'):
+            headers['If-None-Match'] = entry.headers['ETag']
+        resp = self.client.open(url, method=method, data=data, headers=headers)
+        self.requests += 1
+        self.bytes += len(resp.get_data())
+        if resp.status_code == 304:
+            return entry
+        if method == 'GET' and resp.status_code == 200:
+            self.entries[url] = resp
+        return resp
+
+
+def bench_revalidate(args):
+    import re
+    import tempfile
+    from urllib.parse import urlencode
+
+    root = tempfile.mkdtemp(prefix='fi_bench_')
+    json_path = make_fi_fixture(root, args.layers, args.intervals, tuple(args.shape))
+    import app as app_module
+    app_module.fi_stores.__init__(json_path)
+    flask_app = app_module.create_app()
+    with open(os.path.join(os.path.dirname(os.path.abspath(app_module.__file__)), 'templates', 'data.html'),
+              encoding='utf-8-sig') as f:
+        assets = re.findall(r"static_url\('([^']+)'\)", f.read())
+    rng = random.Random(0)
+    lookups = [{'net': 'vgg', 'layer': 'conv{}'.format(rng.randrange(args.layers)),
+                'interval': rng.randrange(args.intervals)} for _ in range(args.lookups)]
+
+    def load(browser, fingerprinted):
+        with flask_app.test_request_context():
+            urls = [app_module.static_url(a) if fingerprinted else '/static/' + a for a in assets]
+        for url in urls:
+            browser.get(url)
+        for q in lookups:
+            if fingerprinted:
+                browser.get('/data?' + urlencode(q))
+            else:
+                browser.get('/data', method='POST', data=q)
+
+    print('dashboard loads: {} static assets, {} /data lookups of {}x{} heatmaps'.format(
+        len(assets), len(lookups), *args.shape))
+    for name, fingerprinted in (('POST /data, plain static', False), ('GET /data + validators, hashed static', True)):
+        browser = _BrowserCache(flask_app.test_client())
+        load(browser, fingerprinted)
+        first = (browser.requests, browser.bytes)
+        for _ in range(args.repeats):
+            load(browser, fingerprinted)
+        requests = (browser.requests - first[0]) / float(args.repeats)
+        sent = (browser.bytes - first[1]) / float(args.repeats)
+        print('  {:<38} first {:4d} req {:10d} B   repeat {:6.1f} req {:10.0f} B'.format(
+            name, first[0], first[1], requests, sent))
+
+
+IMPORT_PROBE = """
+import resource, sys, time
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(dt, rss / 1024.0 if sys.platform != 'darwin' else rss / 1024.0 / 1024.0)
+"""
+
+
+def measure_import(module, repeat=3):
+    """Best-of-``repeat`` import time (s) and peak RSS (MB) in a fresh interpreter."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE.format(module=module)], cwd=here)
+        dt, rss = (float(v) for v in out.decode().split()[-2:])
+        if best is None or dt < best[0]:
+            best = (dt, rss)
+    return best
+
+
+def bench_startup(args):
+    failed = False
+    for module in args.modules:
+        dt, rss = measure_import(module, args.repeat)
+        over = (args.max_seconds is not None and dt > args.max_seconds) or \
+               (args.max_rss_mb is not None and rss > args.max_rss_mb)
+        failed = failed or over
+        print('import {:<10} {:7.3f} s  {:8.1f} MB{}'.format(module, dt, rss, '  OVER BUDGET' if over else ''))
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='cmd')
+    sub.required = True
+
+    p = sub.add_parser('lookup', help='FI_data.json lookup per /data request')
+    p.add_argument('--layers', type=int, default=20)
+    p.add_argument('--intervals', type=int, default=50)
+    p.add_argument('--repeat', type=int, default=200)
+    p.set_defaults(func=bench_lookup)
+
+    p = sub.add_parser('heatmap', help='heatmap txt parsing vs npy sidecar / LRU')
+    p.add_argument('--size', type=int, default=512)
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_heatmap)
+
+    p = sub.add_parser('payload', help='/data response size and encode time per format')
+    p.add_argument('--size', type=int, default=512)
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_payload)
+
+    p = sub.add_parser('load', help='load test / and /data on a running server')
+    p.add_argument('--url', default='http://127.0.0.1:10080')
+    p.add_argument('--net', default='')
+    p.add_argument('--layer', default='conv1')
+    p.add_argument('--interval', type=int, default=0)
+    p.add_argument('--requests', type=int, default=500)
+    p.add_argument('--concurrency', type=int, default=8)
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser('startup', help='import time and RSS of app / dataclean')
+    p.add_argument('--modules', nargs='+', default=['app', 'dataclean'])
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--max-seconds', type=float, default=None, help='exit 1 when an import is slower')
+    p.add_argument('--max-rss-mb', type=float, default=None, help='exit 1 when an import uses more memory')
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('predict', help='CNN.predict_proba per cross-validation fold')
+    p.add_argument('--size', type=int, default=10000)
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.add_argument('--folds', type=int, nargs='+', default=[2, 5, 10])
+    p.set_defaults(func=bench_predict)
+
+    p = sub.add_parser('fit', help='CNN.fit time versus training subset size')
+    p.add_argument('--size', type=int, default=10000)
+    p.add_argument('--subsets', type=int, nargs='+', default=[64, 640, 6400])
+    p.set_defaults(func=bench_fit)
+
+    p = sub.add_parser('postprocess', help='run_cleanlab post-processing, loops vs numpy')
+    p.add_argument('--sizes', type=int, nargs='+', default=[64, 10000, 1000000])
+    p.add_argument('--legacy-max', type=int, default=10000,
+                   help='skip the O(N x PERT_NUM) loop version above this N')
+    p.set_defaults(func=bench_postprocess)
+
+    p = sub.add_parser('pert', help='get_pert, rejection sampling vs vectorized')
+    p.add_argument('--size', type=int, default=1000000)
+    p.add_argument('--fractions', type=float, nargs='+', default=[0.01, 0.5, 0.9])
+    p.add_argument('--legacy-max', type=int, default=200000)
+    p.set_defaults(func=bench_pert)
+
+    p = sub.add_parser('keti-stress', help='parallel writers on one keti2.json')
+    p.add_argument('--writers', type=int, default=16)
+    p.add_argument('--updates', type=int, default=50)
+    p.set_defaults(func=bench_keti_stress)
+
+    p = sub.add_parser('loader', help='torchvision ToTensor loader vs uint8 tensor cache')
+    p.add_argument('--dataset', default='CIFAR10', choices=['CIFAR10', 'MNIST'])
+    p.add_argument('--root', default='./data')
+    p.add_argument('--batch-size', type=int, default=64)
+    p.add_argument('--batches', type=int, default=200)
+    p.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    p.set_defaults(func=bench_loader)
+
+    p = sub.add_parser('spans', help='profiling span overhead, disabled vs enabled')
+    p.add_argument('--n', type=int, default=200000)
+    p.set_defaults(func=bench_spans)
+
+    p = sub.add_parser('warmstart', help='CV fold accuracy and time, cold vs warm-started clones')
+    p.add_argument('--size', type=int, default=2000)
+    p.add_argument('--folds', type=int, default=5)
+    p.add_argument('--pretrain-epochs', type=int, default=10)
+    p.add_argument('--signal', type=float, default=0.6)
+    p.add_argument('--lr', type=float, default=0.05)
+    p.set_defaults(func=bench_warmstart)
+
+    p = sub.add_parser('inference', help='eager model vs fused / int8 TorchScript export')
+    p.add_argument('--model', default='CIFAR10', choices=['CIFAR10', 'MNIST'])
+    p.add_argument('--size', type=int, default=2048)
+    p.add_argument('--batch-size', type=int, default=256)
+    p.set_defaults(func=bench_inference)
+
+    p = sub.add_parser('revalidate', help='bytes sent for repeated dashboard loads, with and without validators')
+    p.add_argument('--layers', type=int, default=4)
+    p.add_argument('--intervals', type=int, default=8)
+    p.add_argument('--shape', type=int, nargs=2, default=[64, 64])
+    p.add_argument('--lookups', type=int, default=5)
+    p.add_argument('--repeats', type=int, default=3)
+    p.set_defaults(func=bench_revalidate)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
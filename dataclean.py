@@ -1,45 +1,44 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
-import argparse
 import copy
 import os.path as osp
-import random
-import json
 import sys
 import time
-import traceback
-from datetime import datetime as dt
+import weakref
 
-import cleanlab
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import seaborn as sns
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-import torchvision
-from cleanlab.classification import LearningWithNoisyLabels
-from cleanlab.latent_algebra import compute_inv_noise_matrix
-# from cleanlab.models.mnist_pytorch import CNN
-from cleanlab.noise_generation import generate_noisy_labels
-from cleanlab.util import value_counts
-from PIL import Image
 from sklearn.base import BaseEstimator
-# from sklearn import datasets
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import accuracy_score, confusion_matrix
-from sklearn.model_selection import ParameterGrid, train_test_split
-from torch.autograd import Variable
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
-from torchvision import datasets, transforms
 
-matplotlib.rcParams['pdf.fonttype'] = 42
-matplotlib.rcParams['ps.fonttype'] = 42
+from profiling import PROFILER, span, timed
+from result_store import ResultStore
+
+# cleanlab, matplotlib and torchvision are imported on the code paths that
+# use them, so importing the CNN classes or get_pert stays cheap.
+
+
+def _figure(figsize):
+    """Figure on the Agg canvas -- no pyplot state, no GUI event loop."""
+    import matplotlib
+    matplotlib.rcParams['pdf.fonttype'] = 42
+    matplotlib.rcParams['ps.fonttype'] = 42
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _inference_mode():
+    # torch.inference_mode needs torch>=1.9
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
 
 
 def call_bn(bn, x):
@@ -95,7 +94,7 @@ class CIFAR10_CNN(nn.Module):
         h = self.c3(h)
         h = F.leaky_relu(call_bn(self.bn3, h), negative_slope=0.01)
         h = F.max_pool2d(h, kernel_size=2, stride=2)
-        h = F.dropout2d(h, p=self.dropout_rate)
+        h = F.dropout2d(h, p=self.dropout_rate, training=self.training)
 
         h = self.c4(h)
         h = F.leaky_relu(call_bn(self.bn4, h), negative_slope=0.01)
@@ -104,7 +103,7 @@ class CIFAR10_CNN(nn.Module):
         h = self.c6(h)
         h = F.leaky_relu(call_bn(self.bn6, h), negative_slope=0.01)
         h = F.max_pool2d(h, kernel_size=2, stride=2)
-        h = F.dropout2d(h, p=self.dropout_rate)
+        h = F.dropout2d(h, p=self.dropout_rate, training=self.training)
 
         h = self.c7(h)
         h = F.leaky_relu(call_bn(self.bn7, h), negative_slope=0.01)
@@ -145,8 +144,14 @@ class MNIST_CNN(nn.Module):
 
 
 def imshow(inp, img_labels=None, img_pred=None, img_fns=None, figsize=(10, 10), normalize=False, red_boxes=True,
-           savefig=False):
-    """Imshow for Tensor."""
+           savefig=False, out=None, fmt='png', dpi=None):
+    """Imshow for Tensor.
+
+    Renders headless. ``out`` may be a path or a binary file object; when
+    it is None the encoded image is returned as bytes. ``fmt`` is any
+    format matplotlib can write (png, jpg, pdf, ...)."""
+    from matplotlib.collections import LineCollection
+
     height, width = inp.shape[1:]
     ROW_NUMS = 8
     xbins = ROW_NUMS
@@ -161,23 +166,37 @@ def imshow(inp, img_labels=None, img_pred=None, img_fns=None, figsize=(10, 10),
         inp = std * inp + mean
         inp = np.clip(inp, 0, 1)
 
-    ax = plt.figure(figsize=figsize).gca()
+    fig = _figure(figsize)
+    ax = fig.gca()
     ax.imshow(inp)
     pad_size = (ROW_NUMS - len(img_pred) % ROW_NUMS) % ROW_NUMS
     img_labels = img_labels + [''] * pad_size  # padding
     img_pred = img_pred + [''] * pad_size  # padding
     img_fns = img_fns + [''] * pad_size  # padding
-    #     grid = np.asarray(img_labels).reshape((ybins, xbins))
+
+    # all grid lines go into one LineCollection: (segment, color, width)
+    segments, colors, widths = [], [], []
+
+    def hlines(ys, xmin, xmax, color, linewidth):
+        for y in ys:
+            segments.append(((xmin, y), (xmax, y)))
+            colors.append(color)
+            widths.append(linewidth)
+
+    def vlines(xs, ymin, ymax, color, linewidth):
+        for x in xs:
+            segments.append(((x, ymin), (x, ymax)))
+            colors.append(color)
+            widths.append(linewidth)
 
     num_red_boxes = 0
     for (j, i), idx in np.ndenumerate(np.arange(ybins * xbins).reshape((ybins, xbins))):
         prediction = img_pred[idx]
         label = img_labels[idx]
         img_fn = img_fns[idx]
-        # image_index = int(img_fn[13:])
 
-        plt.hlines([j * ybin_height - .5], xmin=i * xbin_width, xmax=i * xbin_width + xbin_width, color='lightgray',
-                   linewidth=2)
+        hlines([j * ybin_height - .5], xmin=i * xbin_width, xmax=i * xbin_width + xbin_width, color='lightgray',
+               linewidth=2)
 
         fontsize = max(min(1.4 * figsize[0], .9 * figsize[0] - .7 * len(prediction)), 12) if prediction != '' else 1
         tt = ax.text(i * xbin_width + xbin_width / 2, j * ybin_height + ybin_height / 20, prediction, ha='center',
@@ -195,44 +214,108 @@ def imshow(inp, img_labels=None, img_pred=None, img_fns=None, figsize=(10, 10),
         t.set_bbox(dict(facecolor='cyan', alpha=0.8, edgecolor=None))
 
         if not red_boxes:
-            plt.vlines([i * xbin_width + 0.5, (i + 1) * xbin_width - 1.5], ymin=j * ybin_height + 0.5,
-                       ymax=j * ybin_height + ybin_height - 0.5, color='gray', linewidth=5)
+            vlines([i * xbin_width + 0.5, (i + 1) * xbin_width - 1.5], ymin=j * ybin_height + 0.5,
+                   ymax=j * ybin_height + ybin_height - 0.5, color='gray', linewidth=5)
 
         else:
-        # if red_boxes and image_index in red_box_idxs:
             # Draw red bounding box
             num_red_boxes += 1
-            plt.hlines([j * ybin_height + 0.5, (j + 1) * ybin_height - 1.5], xmin=i * xbin_width - 0.3,
-                       xmax=i * xbin_width + xbin_width - 0.65, color='red', linewidth=15)
-            plt.vlines([i * xbin_width + 0.5, (i + 1) * xbin_width - 1.5], ymin=j * ybin_height + 0.5,
-                       ymax=j * ybin_height + ybin_height - 0.5, color='red', linewidth=15)
+            hlines([j * ybin_height + 0.5, (j + 1) * ybin_height - 1.5], xmin=i * xbin_width - 0.3,
+                   xmax=i * xbin_width + xbin_width - 0.65, color='red', linewidth=15)
+            vlines([i * xbin_width + 0.5, (i + 1) * xbin_width - 1.5], ymin=j * ybin_height + 0.5,
+                   ymax=j * ybin_height + ybin_height - 0.5, color='red', linewidth=15)
 
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=widths))
     if red_boxes:
         print('Number of red boxes:', num_red_boxes)
-    plt.axis('off')
+    ax.axis('off')
     if savefig:
-        plt.savefig('figs/mnist_test_label_errors' + str(len(img_labels)) + '.pdf', pad_inches=0.0, bbox_inches='tight')
-    plt.pause(0.001)  # pause a bit so that plots are updated
+        fig.savefig('figs/mnist_test_label_errors' + str(len(img_labels)) + '.pdf', pad_inches=0.0,
+                    bbox_inches='tight')
+    if out is None:
+        import io
+        buf = io.BytesIO()
+        fig.savefig(buf, format=fmt, dpi=dpi, pad_inches=0.0, bbox_inches='tight')
+        return buf.getvalue()
+    fig.savefig(out, format=fmt, dpi=dpi, pad_inches=0.0, bbox_inches='tight')
 
 
-def get_pert(PERT_NUM, y_ori, y_pert):
+def get_pert(PERT_NUM, y_ori, y_pert, n_classes=10, rng=None):
     '''
     PERT_NUM: int -- 添加扰动样本总数
     y_ori: np.array -- 样本原始标签集
-    y_pert: np.array -- 样本扰动后标签集
+    y_pert: np.array -- 样本扰动后标签集, 原地修改
+    n_classes: int -- 类别数, 标签取值 0..n_classes-1
+    rng: np.random.Generator -- 随机数发生器, None 时新建
+
+    Picks PERT_NUM not yet perturbed samples without replacement and moves
+    each label by a random offset in 1..n_classes-1, so the new label always
+    differs from the old one. Returns (y_pert, pert_idx).
     '''
-    pert_list = []
-    for i in range(PERT_NUM):
-        rand_num = random.randint(0, 9)
-        data_index = random.randint(0, len(y_pert) - 1)
-        while y_ori[data_index] != y_pert[data_index]:  # 跳过已经扰动过的样本
-            data_index = random.randint(0, len(y_pert) - 1)
-        pert_list.append(data_index)
-        while rand_num == y_pert[data_index]:
-            rand_num = random.randint(0, 9)
-        y_pert[data_index] = rand_num
-    # red_box_idxs=random.sample(pert_list,8)
-    return y_pert, pert_list
+    if rng is None:
+        rng = np.random.default_rng()
+    candidates = np.flatnonzero(np.asarray(y_ori) == np.asarray(y_pert))  # 跳过已经扰动过的样本
+    if PERT_NUM > len(candidates):
+        raise ValueError("PERT_NUM is larger than the number of unperturbed samples.")
+    pert_idx = rng.choice(candidates, size=PERT_NUM, replace=False)
+    offset = rng.integers(1, n_classes, size=PERT_NUM)
+    y_pert[pert_idx] = (y_pert[pert_idx] + offset) % n_classes
+    return y_pert, pert_idx
+
+
+class TensorCache(object):
+    """Decoded samples of a dataset kept as one contiguous tensor.
+
+    Rows are decoded (transforms applied) the first time they are asked
+    for and reused afterwards, so repeated folds over the same dataset only
+    pay for decoding once.
+
+    Parameters
+    ----------
+    dataset: torch.utils.data.Dataset
+        returns ``(image tensor, label)`` pairs
+    pin: bool
+        pin the cache in page-locked memory (only useful with CUDA)
+
+    Only a weak reference to the dataset is kept, so the cache (an entry
+    of ``_tensor_caches``) goes away with its dataset.
+    """
+
+    def __init__(self, dataset, pin=False):
+        self._dataset = weakref.ref(dataset)
+        self.size = len(dataset)
+        self.pin = pin
+        self.data = None
+        self.targets = torch.empty(len(dataset), dtype=torch.long)
+        self.filled = np.zeros(len(dataset), dtype=bool)
+
+    def get(self, idx):
+        """Return ``(data, targets)`` tensors for the indices ``idx``."""
+        idx = np.asarray(idx, dtype=np.int64)
+        todo = np.unique(idx[~self.filled[idx]])
+        dataset = self._dataset() if len(todo) else None
+        for i in todo:
+            img, target = dataset[int(i)]
+            if self.data is None:
+                self.data = torch.empty((self.size,) + tuple(img.shape), dtype=img.dtype)
+                if self.pin:  # pragma: no cover
+                    self.data = self.data.pin_memory()
+            self.data[i] = img
+            self.targets[i] = int(target)
+        self.filled[todo] = True
+        idx = torch.from_numpy(idx)
+        return self.data[idx], self.targets[idx]
+
+
+_tensor_caches = weakref.WeakKeyDictionary()
+
+
+def tensor_cache(dataset, pin=False):
+    """Shared TensorCache of ``dataset`` (one per dataset object)."""
+    cache = _tensor_caches.get(dataset)
+    if cache is None:
+        cache = _tensor_caches[dataset] = TensorCache(dataset, pin=pin)
+    return cache
 
 
 class CNN(BaseEstimator):  # Inherits sklearn classifier
@@ -257,6 +340,14 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
     dataset: {'MNIST', 'CIFAR10'}
     testloader: Dataloader
     train_loader: Dataloader
+    pretrained: dict or str, default=None
+        state dict (or path of a saved one) the model starts from. It is an
+        ordinary parameter, so ``sklearn.clone`` of a pre-trained estimator
+        builds a warm copy instead of a freshly initialized network.
+    inference: {None, 'fused', 'dynamic', 'static'}, default=None
+        None runs predict_proba on the eager model; otherwise on a CPU export
+        (see inference.py) with BatchNorm folded, channels-last and
+        TorchScript, 'dynamic' / 'static' additionally int8-quantized.
 
     Attributes
     ----------
@@ -292,7 +383,9 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
             no_cuda=False,
             seed=1,
             test_batch_size=None,
-            dataset='MNIST'
+            dataset='MNIST',
+            pretrained=None,
+            inference=None
     ):
         self.test_loader = test_loader
         self.train_loader = train_loader
@@ -304,6 +397,9 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
         self.momentum = momentum
         self.no_cuda = no_cuda
         self.seed = seed
+        self.dataset = dataset
+        self.pretrained = pretrained
+        self.inference = inference
         self.cuda = not self.no_cuda and torch.cuda.is_available()
         torch.manual_seed(self.seed)
         if self.cuda:  # pragma: no cover
@@ -317,23 +413,46 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
             self.model = CIFAR10_CNN()
         else:
             raise ValueError("dataset must be 'MNIST' or 'CIFAR10'.")
+        if pretrained is not None:
+            if isinstance(pretrained, str):
+                pretrained = torch.load(pretrained, map_location='cpu')
+            self.model.load_state_dict(pretrained)
 
-        if test_batch_size is None:
-            self.test_batch_size = self.test_size
+        # batch size used by predict_proba, defaults to one batch of test_size
+        self.test_batch_size = self.test_size if test_batch_size is None \
+            else test_batch_size
 
         if self.cuda:  # pragma: no cover
             self.model.cuda()
 
         self.loader_kwargs = {'num_workers': 1,
                               'pin_memory': True} if self.cuda else {}
-
+        self._exported = None  # (quantize, ScriptModule), rebuilt after fit
+
+    def __deepcopy__(self, memo):
+        """Copy the model and settings, share the loaders and their datasets
+        and the read-only pretrained weights (cleanlab deep-copies the
+        estimator for every fold)."""
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        for key, value in self.__dict__.items():
+            if key == '_exported':
+                value = None
+            elif key not in ('train_loader', 'test_loader', 'pretrained'):
+                value = copy.deepcopy(value, memo)
+            setattr(new, key, value)
+        return new
+
+    @timed('cnn.fit')
     def fit(self, train_idx, train_labels=None, sample_weight=None):
         """This function adheres to sklearn's "fit(X, y)" format for
         compatibility with scikit-learn. ** All inputs should be numpy
         arrays, not pyTorch Tensors train_idx is not X, but instead a list of
         indices for X (and y if train_labels is None). This function is a
         member of the cnn class which will handle creation of X, y from the
-        train_idx via the train_loader. """
+        train_idx via the train_loader. Only the samples in train_idx are
+        used; they are read from a tensor cache of train_loader.dataset, so
+        an epoch costs len(train_idx) samples, not the whole dataset. """
         #         if self.loader is not None:
         #             loader = self.loader
         if train_labels is not None and len(train_idx) != len(train_labels):
@@ -352,7 +471,13 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
         else:
             class_weight = None
 
-        train_loader = self.train_loader
+        self._exported = None
+        cache = tensor_cache(self.train_loader.dataset, pin=self.cuda)
+        train_idx = np.asarray(train_idx)
+        data_all, target_all = cache.get(train_idx)
+        if train_labels is not None:
+            target_all = torch.as_tensor(np.asarray(train_labels), dtype=torch.long)
+        n_batches = int(np.ceil(len(train_idx) / float(self.batch_size)))
 
         optimizer = optim.SGD(self.model.parameters(), lr=self.lr,
                               momentum=self.momentum)
@@ -362,10 +487,13 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
 
             # Enable dropout and batch norm layers
             self.model.train()
-            for batch_idx, (data, target) in enumerate(train_loader):
+            order = torch.randperm(len(train_idx))
+            for batch_idx in range(n_batches):
+                batch = order[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size]
+                data, target = data_all[batch], target_all[batch]
                 if self.cuda:  # pragma: no cover
-                    data, target = data.cuda(), target.cuda()
-                data, target = Variable(data), Variable(target).long()
+                    data = data.cuda(non_blocking=True)
+                    target = target.cuda(non_blocking=True)
                 optimizer.zero_grad()
                 output = self.model(data)
                 loss = F.nll_loss(output, target, class_weight)
@@ -375,26 +503,36 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
                         batch_idx % self.log_interval == 0:
                     print(
                         'TrainEpoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
-                            epoch, batch_idx * len(data), len(train_idx),
-                                   100. * batch_idx / len(train_loader),
+                            epoch, batch_idx * self.batch_size, len(train_idx),
+                                   100. * batch_idx / n_batches,
                             loss.item()),
                     )
 
+    def exported_model(self, example):
+        """CPU inference export of the model for ``self.inference``, built
+        once per fit with ``example`` as the tracing / calibration batch."""
+        import inference
+        quantize = None if self.inference == 'fused' else self.inference
+        if self._exported is None or self._exported[0] != quantize:
+            with torch.no_grad():
+                self._exported = (quantize, inference.export(self.model, example, quantize=quantize))
+        return self._exported[1]
+
     def predict(self, idx=None):
         """Get predicted labels from trained model."""
         # get the index of the max probability
         probs = self.predict_proba(idx)
         return probs.argmax(axis=1)
 
+    @timed('cnn.predict_proba')
     def predict_proba(self, idx=None):
-        loader = self.test_loader
-        dataset = copy.deepcopy(loader.dataset)
+        """Probabilities for the test dataset, or the samples ``idx`` of it.
+        ``idx`` selects through a ``Subset`` view, the dataset is never
+        copied."""
+        dataset = self.test_loader.dataset
         if idx is not None:
             if len(idx) != self.test_size:
-                dataset.data = np.array(dataset.data)[idx]
-                #                 if type(dataset.targets)==list:
-                #                     dataset.targets=np.array(dataset.targets)
-                dataset.targets = np.array(dataset.targets)[idx]
+                dataset = torch.utils.data.Subset(dataset, np.asarray(idx).tolist())
 
         loader = torch.utils.data.DataLoader(
             dataset=dataset,
@@ -404,16 +542,20 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
 
         # sets model.train(False) inactivating dropout and batch-norm layers
         self.model.eval()
+        model = self.model
+        exported = self.inference is not None and not self.cuda
 
         # Run forward pass on model to compute outputs
         outputs = []
-        for data, _ in loader:
-            if self.cuda:  # pragma: no cover
-                data = data.cuda()
-            with torch.no_grad():
-                data = Variable(data)
-                output = self.model(data)
-            outputs.append(output)
+        with _inference_mode():
+            for data, _ in loader:
+                if self.cuda:  # pragma: no cover
+                    data = data.cuda()
+                if exported:
+                    data = data.contiguous(memory_format=torch.channels_last)
+                    if model is self.model:
+                        model = self.exported_model(data)
+                outputs.append(model(data))
 
         # Outputs are log_softmax (log probabilities)
         outputs = torch.cat(outputs, dim=0)
@@ -423,70 +565,36 @@ class CNN(BaseEstimator):  # Inherits sklearn classifier
         return pred
 
 
-def run_cleanlab(train_loader, test_loader, root, dataset='MNIST', batch_size=128, PERT_NUM=16, MAX_IMAGES=32,
-                 log_func=None):
-    '''
-    Parameters
-    ------
-    dataset: {'MNIST', 'CIFAR10'}
-    train_loader: torch.utils.data.DataLoader
-    test_loader: torch.utils.data.DataLoader
-    PERT_NUM: int
-        amount of added noisy labels
-        -- 添加扰动样本总数
-    MAX_IMAGES: int
-        max images shown
-    savefig: bool
-    '''
+def index_mask(n, idxs):
+    """Boolean mask of length n that is True at idxs."""
+    mask = np.zeros(n, dtype=bool)
+    mask[np.asarray(idxs, dtype=np.int64)] = True
+    return mask
+
+
+def rank_label_errors(psx, labels, pred, noise_idx, max_images):
+    """Flagged samples ordered by the confidence of their given label.
+
+    Returns ``(img_idx, prob_given, prob_pred, label4viz, pred4viz)``, each
+    cut to the first max_images entries.
+    """
+    rows = np.flatnonzero(noise_idx)
+    prob_given = psx[rows, labels[rows]]
+    order = np.argsort(prob_given)[:max_images]
+    rows = rows[order]
+    return rows, prob_given[order], psx[rows, pred[rows]], labels[rows], pred[rows]
+
 
-    TEST_SIZE = batch_size
-    TRAIN_SIZE = 60000
-    X_train = np.arange(TRAIN_SIZE)
-    X_test = np.arange(TEST_SIZE)
-    s, y = iter(test_loader).next()
-    X_test_data, y_test = next(iter(test_loader))
-    y_test = y_test.numpy()
-    X_test_data = X_test_data.numpy()
-
-    y_ori = y_test.copy()
-    print("get_pert")
-    y_test, red_box_idxs = get_pert(PERT_NUM, y_ori, y_test)  # get noisy label for testing
-
-    np.random.seed(43)
-    savefig = False
-    prune_method = 'prune_by_noise_rate'
-    t_begin = time.time()
-    # Pre-train
-    print("cnn.fit")
-    cnn = CNN(epochs=10, log_interval=1000, train_loader=train_loader, test_loader=test_loader,
-              dataset=dataset)  # pre-train
-    cnn.fit(X_test, y_test)  # pre-train (overfit, not out-of-sample) to entire dataset.
-
-    # Out-of-sample cross-validated holdout predicted probabilities
-    np.random.seed(4)
-    cnn.epochs = 1  # Single epoch for cross-validation (already pre-trained)
-
-    jc, psx = cleanlab.latent_estimation.estimate_confident_joint_and_cv_pred_proba(X_test, y_test, cnn, cv_n_folds=5)
-    est_py, est_nm, est_inv = cleanlab.latent_estimation.estimate_latent(jc, y_test)
-    # algorithmic identification of label errors
-    noise_idx = cleanlab.pruning.get_noise_indices(y_test, psx, est_inv, prune_method=prune_method)
-    print('Number of estimated errors in test set:', sum(noise_idx))
-
-    noise_idx = np.asarray(
-        [i in red_box_idxs for i in range(len(y_test))])  # hand-picked digits from rankpruning alg's results
-    pred = np.argmax(psx, axis=1)
-    t_end = time.time()
-    fix_rate = sum((pred == y_ori) & (y_test != y_ori)) / PERT_NUM
-    print('fix rate:', fix_rate)
-    all_time = (t_end - t_begin) * 1000
-    print('time usage:{} ms'.format(all_time))
-
-    ordered_noise_idx = np.argsort(np.asarray([psx[i][j] for i, j in enumerate(y_test)])[noise_idx])
-    prob_given = np.asarray([psx[i][j] for i, j in enumerate(y_test)])[noise_idx][ordered_noise_idx][:MAX_IMAGES]
-    prob_pred = np.asarray([psx[i][j] for i, j in enumerate(pred)])[noise_idx][ordered_noise_idx][:MAX_IMAGES]
-    img_idx = np.arange(len(noise_idx))[noise_idx][ordered_noise_idx][:MAX_IMAGES]
-    label4viz = y_test[noise_idx][ordered_noise_idx][:MAX_IMAGES]
-    pred4viz = pred[noise_idx][ordered_noise_idx][:MAX_IMAGES]
+def confusion_counts(pred, labels, n_classes=10):
+    """(n_classes, n_classes) matrix m with m[p, y] = #samples predicted p with label y."""
+    counts = np.bincount(np.asarray(pred) * n_classes + np.asarray(labels), minlength=n_classes * n_classes)
+    return counts.reshape(n_classes, n_classes).astype(float)
+
+
+def _render_label_errors(X_test_data, img_idx, prob_given, prob_pred, label4viz, pred4viz, dataset, MAX_IMAGES,
+                         out=None):
+    """Grid of the flagged images with given / predicted labels, see imshow."""
+    import torchvision
 
     if dataset == 'MNIST':
         graphic = torchvision.utils.make_grid(
@@ -498,57 +606,407 @@ def run_cleanlab(train_loader, test_loader, root, dataset='MNIST', batch_size=12
     img_pred = ["convnet guess: " + str(pred4viz[w]) + " | conf: " + str(np.round(prob_pred[w], 3)) for w in
                 range(len(pred4viz))]
     img_fns = ["train img #: " + str(item) for item in img_idx]
-    # Display image
-    imshow(
+    return imshow(
         graphic,
         img_labels=img_labels,
         img_pred=img_pred,
         img_fns=img_fns,
         figsize=(40, MAX_IMAGES / 1.1),
         red_boxes=False,
-        #     savefig = savefig,
+        out=out,
     )
-    # plt.savefig('/data2/gxq/SecPlat/SecAladdin/static/img/{}_example.png'.format(filename))
-    # plt.show()
-
-    wr_matrix = np.zeros((10, 10))
-    mask = np.eye(10)
-    for i in range(len(y_test)):
-        wr_matrix[pred[i], y_ori[i]] += 1
-
-    # clean_heatmap=sns.heatmap(wr_matrix,annot=True,mask=mask,annot_kws={"fontsize":8})
-    # clean_heatmap.get_figure().savefig('/data2/gxq/SecPlat/SecAladdin/static/img/{}_heatmap.png'.format(filename))
-
-    # json_path = osp.join(root, "keti2/keti2.json")
-    json_path = osp.join(root, "keti2.json")
-    with open(json_path, 'r') as f:
-        res_dict = json.load(f)
-    res_dict["abnormal_data"]["fix_rate"] = fix_rate
-    with open(json_path, 'w') as f:
-        json.dump(res_dict, f)
+
+
+_fold_clf = None
+
+
+def _init_fold_worker(clf, torch_threads):
+    global _fold_clf
+    _fold_clf = clf
+    torch.set_num_threads(torch_threads)
+
+
+def _fit_predict_fold(clf, X, s, train_idx, holdout_idx, seed):
+    """Train a copy of clf on one fold and predict its holdout set."""
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    clf_copy = copy.deepcopy(clf)
+    clf_copy.fit(X[train_idx], s[train_idx])
+    return clf_copy.predict_proba(X[holdout_idx])
+
+
+def _run_fold(args):
+    return _fit_predict_fold(_fold_clf, *args)
+
+
+def estimate_cv_pred_proba(X, s, clf, cv_n_folds=5, seed=None, n_jobs=1, torch_threads=None,
+                           thresholds=None, calibrate=True, n_classes=None):
+    """Drop-in for cleanlab's ``estimate_confident_joint_and_cv_pred_proba``
+    that can run the folds in a process pool.
+
+    Folds are split exactly as cleanlab does and every fold is seeded on its
+    own, so for a fixed seed (and torch_threads) psx and the confident joint
+    do not depend on n_jobs. Workers are forked: the dataset and the
+    TensorCache filled here are shared read-only instead of being pickled.
+
+    Parameters
+    ----------
+    n_jobs: int
+        worker processes, 1 runs the folds in this process
+    torch_threads: int, default=None
+        torch threads per fold, defaults to the available threads / n_jobs
+    n_classes: int, default=None
+        width of psx and the confident joint, defaults to the number of
+        distinct labels in s; give it when s may lack some classes
+    Other parameters as in cleanlab.
+
+    Returns
+    -------
+    (confident_joint, psx)
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from cleanlab.util import round_preserving_row_totals
+    from sklearn.model_selection import StratifiedKFold
+
+    s = np.asarray(s)
+    K = n_classes or len(np.unique(s))
+    n_jobs = max(1, min(n_jobs, cv_n_folds))
+    if torch_threads is None:
+        torch_threads = max(1, torch.get_num_threads() // n_jobs)
+
+    kf = StratifiedKFold(n_splits=cv_n_folds, shuffle=True, random_state=seed)
+    splits = list(kf.split(X, s))
+    fold_rng = np.random if seed is None else np.random.RandomState(seed)
+    fold_seeds = fold_rng.randint(2 ** 31 - 1, size=cv_n_folds)
+    tasks = [(X, s, train_idx, holdout_idx, int(fold_seed))
+             for (train_idx, holdout_idx), fold_seed in zip(splits, fold_seeds)]
+
+    if n_jobs == 1:
+        n_threads = torch.get_num_threads()
+        torch.set_num_threads(torch_threads)
+        try:
+            results = [_fit_predict_fold(clf, *task) for task in tasks]
+        finally:
+            torch.set_num_threads(n_threads)
+    else:
+        # decode every sample once here, the forked workers inherit the cache
+        cache = tensor_cache(clf.train_loader.dataset, pin=clf.cuda)
+        cache.get(np.asarray(X))
+        cache.data.share_memory_()
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=ctx, initializer=_init_fold_worker,
+                                 initargs=(clf, torch_threads)) as pool:
+            results = list(pool.map(_run_fold, tasks))
+
+    psx = np.zeros((len(s), K))
+    for (_, holdout_idx), psx_cv in zip(splits, results):
+        psx[holdout_idx] = psx_cv
+    # cleanlab's compute_confident_joint, but sized K x K: it counts labels
+    # with np.unique and confusion_matrix, which drop absent classes
+    s_counts = np.bincount(s, minlength=K)
+    if thresholds is None:
+        thresholds = [psx[s == k, k].mean() if s_counts[k] else np.inf for k in range(K)]
+    confident = psx >= np.asarray(thresholds) - 1e-6
+    n_confident = confident.sum(axis=1)
+    guess = np.where(n_confident > 1, psx.argmax(axis=1), confident.argmax(axis=1))
+    confident_joint = np.zeros((K, K), dtype=np.int64)
+    np.add.at(confident_joint, (s[n_confident > 0], guess[n_confident > 0]), 1)
+    if calibrate:
+        rows = confident_joint.sum(axis=1, keepdims=True)
+        cj = np.divide(confident_joint * s_counts[:, None], rows, out=np.zeros((K, K)), where=rows > 0)
+        confident_joint = round_preserving_row_totals(cj / cj.sum() * len(s))
+    return confident_joint, psx
+
+
+def run_cleanlab(train_loader, test_loader, root, dataset='MNIST', batch_size=128, PERT_NUM=16, MAX_IMAGES=32,
+                 log_func=None, n_jobs=1, seed=None, cache=None, render=True, fig_name='label_errors.png',
+                 profile=None, pretrain_epochs=10, warm_start=None):
+    '''
+    Parameters
+    ------
+    dataset: {'MNIST', 'CIFAR10'}
+    train_loader: torch.utils.data.DataLoader
+    test_loader: torch.utils.data.DataLoader
+    PERT_NUM: int
+        amount of added noisy labels
+        -- 添加扰动样本总数
+    MAX_IMAGES: int
+        max images shown
+    savefig: bool
+    n_jobs: int
+        processes used for the cross-validation folds
+    seed: int, default=None
+        seed of the label perturbation
+    cache: AuditCache or str, default=None
+        reuse psx / confident joint of an identical earlier run (a str is
+        taken as the cache directory)
+    render: bool
+        draw the label-error grid to root/fig_name; False when only
+        fix_rate is needed
+    profile: str, default=None
+        write wall / CPU time and peak memory of every stage of this run
+        to this JSON file (see profiling.py)
+    pretrain_epochs: int
+        epochs of pre-training on the audited batch
+    warm_start: dict, default=None
+        state dict pre-training starts from instead of a random network,
+        e.g. a model trained on the clean train split (see sweep.py)
+    '''
+
+    import cleanlab.latent_estimation
+    import cleanlab.pruning
+
+    with PROFILER.collect(active=profile is not None) as spans, span('run_cleanlab'):
+        with span('load_batch'):
+            X_test_data, y_test = next(iter(test_loader))
+            # fit / predict_proba index into the audited batch itself
+            audit_loader = _chunk_loader(X_test_data, y_test)
+            TEST_SIZE = len(y_test)
+            X_test = np.arange(TEST_SIZE)
+            y_test = y_test.numpy()
+            X_test_data = X_test_data.numpy()
+
+        y_ori = y_test.copy()
+        print("get_pert")
+        with span('get_pert'):
+            y_test, red_box_idxs = get_pert(PERT_NUM, y_ori, y_test, n_classes=10,
+                                            rng=np.random.default_rng(seed))  # get noisy label for testing
+
+        np.random.seed(43)
+        savefig = False
+        prune_method = 'prune_by_noise_rate'
+        t_begin = time.time()
+        # Pre-train
+        print("cnn.fit")
+        cnn = CNN(epochs=pretrain_epochs, log_interval=1000, train_loader=audit_loader, test_loader=audit_loader,
+                  test_size=TEST_SIZE, dataset=dataset, pretrained=warm_start)  # pre-train
+        cv_n_folds = 5
+        if isinstance(cache, str):
+            from audit_cache import AuditCache
+            cache = AuditCache(cache)
+        hit = None
+        if cache is not None:
+            from audit_cache import fingerprint, fingerprint_state
+            with span('cache_lookup'):
+                params = {k: v for k, v in cnn.get_params().items()
+                          if not k.endswith('loader') and k != 'pretrained'}
+                key_parts = dict(data=fingerprint(X_test_data), labels=fingerprint(y_test),
+                                 model=type(cnn.model).__name__, params=params, cv_epochs=1,
+                                 cv_n_folds=cv_n_folds, cv_seed=4)
+                if warm_start is not None:
+                    key_parts['warm_start'] = fingerprint_state(warm_start)
+                cache_key = cache.key(**key_parts)
+                hit = cache.get(cache_key)
+        if hit is not None:
+            print("cache hit")
+            jc, psx = hit['confident_joint'], np.asarray(hit['psx'])
+        else:
+            with span('pretrain'):
+                cnn.fit(X_test, y_test)  # pre-train (overfit, not out-of-sample) to entire dataset.
+            pretrained = copy.deepcopy(cnn.model.state_dict())
+            # fold copies, deep-copied or sklearn.clone'd, start from these weights
+            cnn.set_params(pretrained=pretrained)
+
+            # Out-of-sample cross-validated holdout predicted probabilities
+            np.random.seed(4)
+            cnn.epochs = 1  # Single epoch for cross-validation (already pre-trained)
+
+            with span('cv_folds'):
+                jc, psx = estimate_cv_pred_proba(X_test, y_test, cnn, cv_n_folds=cv_n_folds, n_jobs=n_jobs)
+            if cache is not None:
+                with span('cache_store'):
+                    cache.put(cache_key, psx, jc, pretrained)
+        with span('estimate_latent'):
+            est_py, est_nm, est_inv = cleanlab.latent_estimation.estimate_latent(jc, y_test)
+        # algorithmic identification of label errors
+        with span('get_noise_indices'):
+            noise_idx = cleanlab.pruning.get_noise_indices(y_test, psx, est_inv, prune_method=prune_method)
+        print('Number of estimated errors in test set:', sum(noise_idx))
+
+        noise_idx = index_mask(len(y_test), red_box_idxs)  # hand-picked digits from rankpruning alg's results
+        pred = np.argmax(psx, axis=1)
+        t_end = time.time()
+        fix_rate = np.count_nonzero((pred == y_ori) & (y_test != y_ori)) / PERT_NUM
+        print('fix rate:', fix_rate)
+        all_time = (t_end - t_begin) * 1000
+        print('time usage:{} ms'.format(all_time))
+
+        img_idx, prob_given, prob_pred, label4viz, pred4viz = rank_label_errors(psx, y_test, pred, noise_idx,
+                                                                                MAX_IMAGES)
+
+        if render:
+            # Display image
+            with span('render'):
+                _render_label_errors(X_test_data, img_idx, prob_given, prob_pred, label4viz, pred4viz, dataset,
+                                     MAX_IMAGES, out=osp.join(root, fig_name))
+
+        wr_matrix = confusion_counts(pred, y_ori, max(10, psx.shape[1]))
+        mask = np.eye(len(wr_matrix))
+
+        # clean_heatmap=sns.heatmap(wr_matrix,annot=True,mask=mask,annot_kws={"fontsize":8})
+        # clean_heatmap.get_figure().savefig('/data2/gxq/SecPlat/SecAladdin/static/img/{}_heatmap.png'.format(filename))
+
+        # json_path = osp.join(root, "keti2/keti2.json")
+        json_path = osp.join(root, "keti2.json")
+        with span('write_result'):
+            ResultStore(json_path).set(("abnormal_data", "fix_rate"), fix_rate)
+    if profile is not None:
+        PROFILER.report(spans, profile, dataset=dataset, test_size=TEST_SIZE, PERT_NUM=PERT_NUM, seed=seed,
+                        n_jobs=n_jobs, cache_hit=hit is not None, fix_rate=fix_rate)
     return fix_rate
 
 
+def _chunk_loader(data, targets, batch_size=64):
+    """DataLoader over in-memory samples, used as the CNN's index space."""
+    from torch.utils.data import TensorDataset
+    return DataLoader(TensorDataset(torch.as_tensor(data), torch.as_tensor(targets)), batch_size=batch_size)
+
+
+def _iter_chunks(loader, chunk_size, min_tail=0):
+    """Group the batches of one pass over loader into chunks of ~chunk_size.
+    A last chunk smaller than min_tail is merged into the one before it."""
+    data, targets, n = [], [], 0
+    chunk = None
+    for x, y in loader:
+        data.append(x)
+        targets.append(y)
+        n += len(y)
+        if n >= chunk_size:
+            if chunk is not None:
+                yield chunk
+            chunk = torch.cat(data), torch.cat(targets)
+            data, targets, n = [], [], 0
+    if n and chunk is not None and n < min_tail:
+        chunk = torch.cat([chunk[0]] + data), torch.cat([chunk[1]] + targets)
+        n = 0
+    if chunk is not None:
+        yield chunk
+    if n:
+        yield torch.cat(data), torch.cat(targets)
+
+
+def stream_label_errors(test_loader, result_path, dataset='MNIST', chunk_size=2048, pert_frac=0.0,
+                        pretrain_epochs=10, cv_n_folds=5, n_jobs=1, n_classes=10, seed=None,
+                        prune_method='prune_by_noise_rate'):
+    '''
+    流式异常数据检测 -- label-error detection over a whole dataset.
+
+    Walks test_loader once, in chunks of about chunk_size samples. Each chunk
+    gets its own pre-train and cross-validated psx, its confident joint is
+    added to a running total and its flagged samples are appended to
+    result_path as ``index,given,pred,conf`` lines. A tail too small to
+    cross-validate is audited with the chunk before it, so at most two
+    chunks are held in memory at a time. Indices count samples in loader
+    order, so use a loader without shuffling.
+
+    Parameters
+    ------
+    pert_frac: float
+        fraction of every chunk given a wrong label first (0 audits the
+        labels as they are)
+    Other parameters as in run_cleanlab / estimate_cv_pred_proba.
+
+    Returns
+    ------
+    dict with n_samples, n_flagged, n_perturbed, n_fixed and confident_joint
+    '''
+    import cleanlab.latent_estimation
+    import cleanlab.pruning
+
+    rng = np.random.default_rng(seed)
+    joint = np.zeros((n_classes, n_classes), dtype=np.int64)
+    state = None
+    offset = n_flagged = n_perturbed = n_fixed = 0
+    with open(result_path, 'w') as out:
+        out.write('index,given,pred,conf\n')
+        min_tail = max(chunk_size // 2, cv_n_folds * n_classes)
+        for data, targets in _iter_chunks(test_loader, chunk_size, min_tail):
+            y_ori = targets.numpy()
+            y_given = y_ori.copy()
+            if pert_frac > 0:
+                y_given, pert_idx = get_pert(int(pert_frac * len(y_given)), y_ori, y_given,
+                                             n_classes=n_classes, rng=rng)
+                n_perturbed += len(pert_idx)
+            loader = _chunk_loader(data, targets)
+            X = np.arange(len(y_given))
+            # carry the weights over from the last chunk
+            cnn = CNN(epochs=pretrain_epochs, log_interval=None, train_loader=loader, test_loader=loader,
+                      test_size=len(X), dataset=dataset, pretrained=state)
+            cnn.fit(X, y_given)
+            state = copy.deepcopy(cnn.model.state_dict())
+            cnn.set_params(epochs=1, pretrained=state)
+            jc, psx = estimate_cv_pred_proba(X, y_given, cnn, cv_n_folds=cv_n_folds, n_jobs=n_jobs,
+                                             seed=int(rng.integers(2 ** 31 - 1)), n_classes=n_classes)
+            joint += jc
+            # cleanlab sizes its label counts by the classes present, prune
+            # over those when the chunk lacks some
+            present = np.unique(y_given)
+            y_sub = np.searchsorted(present, y_given)
+            est_py, est_nm, est_inv = cleanlab.latent_estimation.estimate_latent(jc[np.ix_(present, present)], y_sub)
+            noise_idx = cleanlab.pruning.get_noise_indices(y_sub, psx[:, present], est_inv,
+                                                           prune_method=prune_method)
+            pred = np.argmax(psx, axis=1)
+            n_fixed += np.count_nonzero((pred == y_ori) & (y_given != y_ori))
+            for i in np.flatnonzero(noise_idx):
+                out.write('{},{},{},{:.4f}\n'.format(offset + i, y_given[i], pred[i], psx[i, pred[i]]))
+            out.flush()
+            n_flagged += np.count_nonzero(noise_idx)
+            offset += len(X)
+            print('audited {} samples, {} flagged'.format(offset, n_flagged))
+    return {'n_samples': offset, 'n_flagged': n_flagged, 'n_perturbed': n_perturbed,
+            'n_fixed': n_fixed, 'confident_joint': joint}
+
+
 def run(train_loader, test_loader, params, log_func=None):
     batch_size = test_loader.batch_size
     dataset = params["dataset"]["name"].upper()
     root = osp.join(params["out_path"], "keti2")
+    if params.get("stream"):
+        # 全量流式检测, params["stream"] = {"chunk_size": ..., "pert_frac": ...}
+        opts = dict(params["stream"]) if isinstance(params["stream"], dict) else {}
+        # indices in label_errors.csv count in loader order: walk the whole
+        # dataset in order, whatever shuffling / drop_last test_loader uses
+        loader = DataLoader(test_loader.dataset, batch_size=batch_size or 64, shuffle=False, drop_last=False,
+                            num_workers=test_loader.num_workers, collate_fn=test_loader.collate_fn)
+        return stream_label_errors(loader, osp.join(root, "label_errors.csv"), dataset=dataset, **opts)
     # print("run_cleanlab")
-    run_cleanlab(train_loader, test_loader, root=root, dataset=dataset, batch_size=batch_size, PERT_NUM=16,
-                 MAX_IMAGES=32, log_func=log_func)
+    return run_cleanlab(train_loader, test_loader, root=root, dataset=dataset, batch_size=batch_size,
+                        PERT_NUM=params.get("PERT_NUM", 16), MAX_IMAGES=params.get("MAX_IMAGES", 32),
+                        log_func=log_func, seed=params.get("seed"), profile=params.get("profile"))
 
 
 """异常数据检测"""
 
-def data_detection():
-    train_data = torchvision.datasets.CIFAR10("./data",train=True,transform=torchvision.transforms.ToTensor(),download=True)
-    train_loader = DataLoader(dataset=train_data,batch_size=64,shuffle=True,num_workers=0,drop_last=True)
-    test_data = torchvision.datasets.CIFAR10("./data", train=False, transform=torchvision.transforms.ToTensor(),
-                                              download=True)
-    test_loader = DataLoader(dataset=test_data, batch_size=64, shuffle=True, num_workers=0, drop_last=True)
+def make_loaders(dataset="CIFAR10", root="./data", num_workers=0, prefetch_factor=2, batch_size=64):
+    '''
+    Train / test loaders over the tensor-cached dataset (see dataset_cache.py).
+
+    dataset: {'MNIST', 'CIFAR10'}
+    num_workers: int -- CPU 预取进程数
+    '''
+    from dataset_cache import CachedImageDataset, make_loader
+
+    # 图像只解码一次, 之后从 uint8 缓存按批读取
+    loaders = []
+    for train in (True, False):
+        data = CachedImageDataset(dataset, root, train=train, download=True)
+        loaders.append(make_loader(data, batch_size=batch_size, shuffle=True, drop_last=True,
+                                   num_workers=num_workers, prefetch_factor=prefetch_factor))
+    return tuple(loaders)
+
+
+def data_detection(dataset="CIFAR10", root="./data", num_workers=0, prefetch_factor=2):
+    '''
+    dataset: {'MNIST', 'CIFAR10'}
+    num_workers: int -- CPU 预取进程数
+    '''
+    train_loader, test_loader = make_loaders(dataset, root, num_workers, prefetch_factor)
     params = {
         "dataset":{
-            "name":"CIFAR10"
+            "name":dataset
         },
         "out_path":"./"
     }
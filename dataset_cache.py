@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""数据集缓存 -- CIFAR-10 / MNIST decoded once into a uint8 tensor file.
+
+The first use writes ``<root>/<name>_<split>_images.npy`` (N, C, H, W uint8)
+and ``<name>_<split>_labels.npy``; afterwards the images are memory-mapped
+and whole batches are indexed and scaled to [0, 1] in one operation instead
+of decoding a PIL image per sample.
+"""
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+from snapshot import write_atomic
+
+DATASETS = ('CIFAR10', 'MNIST')
+
+
+def _to_nchw(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if data.ndim == 3:  # MNIST: N, H, W
+        return data[:, None]
+    return data.transpose(0, 3, 1, 2)  # CIFAR10: N, H, W, C
+
+
+def build_cache(name, root='./data', train=True, download=True):
+    """Decode a torchvision dataset into the cache files; returns their paths."""
+    import torchvision
+
+    name = name.upper()
+    if name not in DATASETS:
+        raise ValueError("dataset must be 'MNIST' or 'CIFAR10'.")
+    split = 'train' if train else 'test'
+    images = os.path.join(root, '{}_{}_images.npy'.format(name.lower(), split))
+    labels = os.path.join(root, '{}_{}_labels.npy'.format(name.lower(), split))
+    if not (os.path.exists(images) and os.path.exists(labels)):
+        ds = getattr(torchvision.datasets, name)(root, train=train, download=download)
+        data = ds.data.numpy() if torch.is_tensor(ds.data) else ds.data
+        targets = ds.targets.numpy() if torch.is_tensor(ds.targets) else ds.targets
+        targets = np.asarray(targets, dtype=np.int64)
+        data = np.ascontiguousarray(_to_nchw(data))
+        write_atomic(labels, lambda f: np.save(f, targets))
+        write_atomic(images, lambda f: np.save(f, data))
+    return images, labels
+
+
+class CachedImageDataset(torch.utils.data.Dataset):
+    """Memory-mapped uint8 image tensor cache.
+
+    ``ds[i]`` returns ``(float image, label)`` like ToTensor would and
+    ``ds[list_of_indices]`` returns a whole normalized batch. A DataLoader
+    gets per-sample tuples from ``__getitems__``, so the default collate
+    works; :func:`make_loader` takes the batch as fetched instead.
+
+    Parameters
+    ----------
+    name: {'MNIST', 'CIFAR10'}
+    root: str
+    train: bool
+    download: bool
+    """
+
+    def __init__(self, name, root='./data', train=True, download=True):
+        images, labels = build_cache(name, root, train, download)
+        self.data = np.load(images, mmap_mode='r')
+        self.targets = np.load(labels)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            return self._batch(idx)
+        x = torch.from_numpy(np.array(self.data[idx]))
+        return x.float().div_(255), int(self.targets[idx])
+
+    def __getitems__(self, idx):
+        return _Batch(*self._batch(idx))
+
+    def _batch(self, idx):
+        idx = np.asarray(idx)
+        x = torch.from_numpy(np.ascontiguousarray(self.data[idx]))
+        return x.float().div_(255), torch.from_numpy(self.targets[idx])
+
+
+class _Batch(list):
+    """Per-sample ``(x, y)`` views of one fetched batch that also keeps the
+    batch tensors, so :func:`_collate` need not stack them again."""
+
+    def __init__(self, x, y):
+        super(_Batch, self).__init__(zip(x, y))
+        self.tensors = (x, y)
+
+
+def _collate(batch):
+    # __getitems__ (torch>=2.0) fetches the batch whole; older torch hands
+    # over single samples
+    if isinstance(batch, _Batch):
+        return batch.tensors
+    return default_collate(batch)
+
+
+def make_loader(dataset, batch_size=64, shuffle=False, drop_last=False, num_workers=0, prefetch_factor=2):
+    """DataLoader fetching whole batches from a CachedImageDataset.
+
+    With ``num_workers > 0`` batches are prepared by that many CPU workers,
+    ``prefetch_factor`` batches ahead each.
+    """
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = {'prefetch_factor': prefetch_factor, 'persistent_workers': True}
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                      num_workers=num_workers, collate_fn=_collate, **kwargs)
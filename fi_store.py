@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""故障注入结果索引 -- in-memory index over FI_data.json."""
+import json
+import os
+import threading
+
+
+HEATMAP_KEYS = ('heatmap_pristine', 'heatmap_noise', 'heatmap_noisedata')
+
+
+class FIStore(object):
+    """Indexed view of a fault-injection result file.
+
+    The json file is parsed once into a dict keyed by
+    ``(layer name, clock-cycles)`` and re-parsed only when its mtime changes,
+    so lookups cost one ``os.stat`` plus a dict access.
+
+    Parameters
+    ----------
+    json_path: str
+        path of the FI_data.json file, heatmap paths inside it are relative
+        to its directory
+    """
+
+    def __init__(self, json_path):
+        self.json_path = json_path
+        self.root_path = os.path.dirname(json_path)
+        self.pristine_acc = None
+        self._index = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """(Re)build the index from disk."""
+        mtime = os.stat(self.json_path).st_mtime_ns
+        with open(self.json_path, 'r') as f:
+            data = json.load(f)
+        pristine_acc = float(data['pristine-acc'][:-1])
+        index = {}
+        for layer in data['layers']:
+            for item in layer['intensity']:
+                record = {
+                    'pristine_acc': pristine_acc,
+                    'layer': layer.get('layer'),
+                    'faulted_acc': item['faulted-acc'],
+                    'average_acc': item['average-acc'],
+                }
+                for key in HEATMAP_KEYS:
+                    record[key] = os.path.join(self.root_path, item[key])
+                index[(layer['name'], item['clock-cycles'])] = record
+        # swap in a single assignment so readers never see a half-built index
+        self.pristine_acc = pristine_acc
+        self._index = index
+        self._mtime = mtime
+
+    def refresh(self):
+        """Reload the file if it changed since the last load."""
+        mtime = os.stat(self.json_path).st_mtime_ns
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self.load()
+
+    def get(self, layer_name, interval):
+        """Return the record for ``(layer_name, interval)`` or None."""
+        self.refresh()
+        return self._index.get((layer_name, interval))
+
+    def select(self, layer_name=None, interval=None):
+        """Records matching a selector, None acts as a wildcard.
+
+        Returns a list of ``((layer name, clock-cycles), record)`` pairs.
+        """
+        if layer_name is not None and interval is not None:
+            record = self.get(layer_name, interval)
+            return [] if record is None else [((layer_name, interval), record)]
+        return sorted((key, record) for key, record in self.items()
+                      if (layer_name is None or key[0] == layer_name)
+                      and (interval is None or key[1] == interval))
+
+    def items(self):
+        """Iterate over ``((layer name, clock-cycles), record)`` pairs."""
+        self.refresh()
+        return self._index.items()
+
+    def __len__(self):
+        return len(self._index)
+
+
+class FIStoreRegistry(object):
+    """One FIStore per network.
+
+    Parameters
+    ----------
+    default_path: str
+        FI_data.json used for networks without an entry in ``paths``
+    paths: dict
+        network name -> FI_data.json path
+    """
+
+    def __init__(self, default_path, paths=None):
+        self.default_path = default_path
+        self.paths = dict(paths or {})
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, net):
+        return self.paths.get(net, self.default_path)
+
+    def store(self, net=None):
+        return self.store_for_path(self.path_for(net))
+
+    def store_for_path(self, path):
+        store = self._stores.get(path)
+        if store is None:
+            with self._lock:
+                store = self._stores.setdefault(path, FIStore(path))
+        return store
+
+    def stores(self):
+        return list(self._stores.values())
+
+    def load_all(self):
+        for path in set(self.paths.values()) | {self.default_path}:
+            self.store_for_path(path).load()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""热力图缓存 -- binary sidecars and a byte-bounded LRU for heatmap txt files.
+
+    python heatmap_cache.py third_party/fault_injection_json/FI_data.json
+
+builds the sidecars and downsampling pyramid of every heatmap in the file.
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from snapshot import write_atomic
+
+
+def read_txt(path):
+    """Parse a whitespace separated integer matrix into the smallest int dtype."""
+    with open(path, 'r') as f:
+        rows = [line.split() for line in f if line.strip()]
+    arr = np.array(rows, dtype=np.int64)
+    if arr.size:
+        dtype = np.promote_types(np.min_scalar_type(int(arr.min())), np.min_scalar_type(int(arr.max())))
+        arr = arr.astype(dtype)
+    return arr
+
+
+def pool2x(arr):
+    """2x2 mean pooling; a trailing odd row/column is averaged on its own."""
+    if arr.ndim != 2 or arr.size == 0:
+        return np.asarray(arr)
+    rows = np.arange(0, arr.shape[0], 2)
+    cols = np.arange(0, arr.shape[1], 2)
+    total = np.add.reduceat(np.add.reduceat(arr.astype(np.float64), rows, axis=0), cols, axis=1)
+    count = np.outer(np.diff(np.append(rows, arr.shape[0])), np.diff(np.append(cols, arr.shape[1])))
+    out = total / count
+    if arr.dtype.kind in 'iu':
+        out = np.rint(out)
+    return out.astype(arr.dtype)
+
+
+def pooled_shape(shape, level):
+    h, w = shape
+    for _ in range(level):
+        h, w = (h + 1) // 2, (w + 1) // 2
+    return h, w
+
+
+def max_level(shape):
+    """Level at which a heatmap of ``shape`` is pooled down to 1x1."""
+    if len(shape) != 2:
+        return 0
+    level = 0
+    while pooled_shape(shape, level) != (1, 1):
+        level += 1
+    return level
+
+
+def sidecar_path(path, level=0):
+    if level == 0:
+        return path + '.npy'
+    return '{}.l{}.npy'.format(path, level)
+
+
+class HeatmapCache(object):
+    """Loads heatmap txt files as numpy arrays.
+
+    The first read of ``x.txt`` writes ``x.txt.npy`` next to it; afterwards the
+    sidecar is memory-mapped instead of re-parsing the text. A sidecar older
+    than its txt file is rebuilt. Level ``k`` of the pyramid is the heatmap
+    mean-pooled ``k`` times by 2x2 and lives in ``x.txt.l<k>.npy``. Loaded
+    arrays are kept in an LRU bounded by ``max_bytes``.
+
+    Parameters
+    ----------
+    max_bytes: int
+        budget for resident arrays, 0 disables the in-memory LRU
+    write_sidecar: bool
+        set to False for read-only result directories
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, write_sidecar=True):
+        self.max_bytes = max_bytes
+        self.write_sidecar = write_sidecar
+        self.nbytes = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, path, level=0):
+        """Return pyramid level ``level`` of the heatmap at ``path`` (read-only).
+
+        Levels past the 1x1 one are clamped to it; a negative level is a
+        ValueError.
+        """
+        if level < 0:
+            raise ValueError('pyramid level must be >= 0, got {}'.format(level))
+        mtime = os.stat(path).st_mtime_ns
+        arr = self._cached((path, level), mtime)
+        if arr is not None:
+            return arr
+        arr = self._level(path, 0, mtime, None)
+        # missing levels are pooled, and written, one from the next lower
+        for k in range(1, min(level, max_level(arr.shape)) + 1):
+            arr = self._level(path, k, mtime, arr)
+        return arr
+
+    def level_for(self, path, max_cells):
+        """Smallest pyramid level whose heatmap has at most ``max_cells`` cells."""
+        shape = self.load(path).shape
+        if len(shape) != 2:
+            return 0
+        level = 0
+        h, w = shape
+        while h * w > max_cells and (h > 1 or w > 1):
+            level += 1
+            h, w = pooled_shape(shape, level)
+        return level
+
+    def build_pyramid(self, path, min_cells=1):
+        """Write every level of ``path`` down to ``min_cells``; returns the level count."""
+        top = self.level_for(path, min_cells)
+        self.load(path, top)  # a missing level is pooled from, and writes, the one below
+        return top + 1
+
+    def _cached(self, key, mtime):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._lru.move_to_end(key)
+                return entry[1]
+        return None
+
+    def _level(self, path, level, mtime, below):
+        arr = self._cached((path, level), mtime)
+        if arr is None:
+            arr = self._load_sidecar(path, mtime, level, below)
+            self._put((path, level), mtime, arr)
+        return arr
+
+    def _load_sidecar(self, path, mtime, level, below):
+        npy = sidecar_path(path, level)
+        try:
+            if os.stat(npy).st_mtime_ns >= mtime:
+                return np.load(npy, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+        arr = read_txt(path) if level == 0 else pool2x(below)
+        if self.write_sidecar:
+            # unique temp file: concurrent requests may build the same sidecar
+            try:
+                write_atomic(npy, lambda f: np.save(f, arr))
+            except OSError:
+                pass
+        arr.flags.writeable = False
+        return arr
+
+    def _put(self, key, mtime, arr):
+        if arr.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1].nbytes
+            self._lru[key] = (mtime, arr)
+            self.nbytes += arr.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._lru.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._lru)
+
+
+if __name__ == '__main__':
+    from fi_store import FIStore, HEATMAP_KEYS
+
+    store = FIStore(sys.argv[1])
+    store.load()
+    cache = HeatmapCache(max_bytes=0)
+    for (layer_name, interval), item in sorted(store.items()):
+        levels = [cache.build_pyramid(item[key]) for key in HEATMAP_KEYS]
+        print('{} {}: {} levels'.format(layer_name, interval, max(levels)))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""HTTP 缓存 -- validators from source files and fingerprinted static assets.
+
+A /data response only depends on FI_data.json and the heatmap files it
+points at, so their (path, mtime, size) make a validator that is known
+before any heatmap is loaded. Static assets are linked with a content hash
+in the query string and served with a far-future, immutable Cache-Control.
+"""
+import hashlib
+import os
+import threading
+from email.utils import formatdate
+
+# one year, the longest max-age caches are expected to honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def file_validators(paths, *variant):
+    """``(etag, last_modified)`` of the files ``paths``.
+
+    ``variant`` (format, resolution, content coding, ...) goes into the
+    etag so every distinct representation gets its own validator.
+    last_modified is a unix timestamp in whole seconds.
+    """
+    h = hashlib.sha1()
+    newest = 0
+    for path in paths:
+        st = os.stat(path)
+        h.update('{}\0{}\0{}\0'.format(path, st.st_mtime_ns, st.st_size).encode('utf-8'))
+        newest = max(newest, st.st_mtime_ns)
+    h.update(repr(variant).encode('utf-8'))
+    return h.hexdigest()[:20], newest // 10 ** 9
+
+
+def not_modified(request, etag, last_modified):
+    """Whether the conditional headers of ``request`` still match.
+
+    If-None-Match wins over If-Modified-Since when both are sent.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and since.timestamp() >= last_modified
+
+
+def set_validators(resp, etag, last_modified):
+    resp.set_etag(etag)
+    resp.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    # cacheable, but must be revalidated on every use
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+class AssetFingerprints(object):
+    """Content hashes of the files under a static folder.
+
+    A hash is recomputed only when the file's mtime or size changes.
+
+    Parameters
+    ----------
+    static_folder: str
+    """
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def fingerprint(self, filename):
+        """Short sha256 of ``static/<filename>``, None if it does not exist."""
+        path = os.path.join(self.static_folder, filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._hashes.get(filename)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()[:12]
+        with self._lock:
+            self._hashes[filename] = (stamp, digest)
+        return digest
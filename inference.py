@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""推理导出 -- CPU inference-only export of CIFAR10_CNN / MNIST_CNN.
+
+BatchNorm is folded into the preceding convolutions, dropout is dropped,
+activations are channels-last and the result is traced and frozen with
+TorchScript. ``quantize='dynamic'`` quantizes the linear layers to int8,
+``quantize='static'`` the whole network after calibrating on a batch.
+"""
+import copy
+import warnings
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+QUANTIZE = (None, 'dynamic', 'static')
+
+
+class FusedCIFAR10(nn.Module):
+    """CIFAR10_CNN in eval mode with every conv+BatchNorm pair folded."""
+
+    def __init__(self, model):
+        super(FusedCIFAR10, self).__init__()
+        if model.top_bn:
+            raise ValueError('top_bn is not supported.')
+        convs = [fuse_conv_bn_eval(getattr(model, 'c{}'.format(i)), getattr(model, 'bn{}'.format(i)))
+                 for i in range(1, 10)]
+
+        def block(layers, pool):
+            mods = []
+            for conv in layers:
+                mods += [conv, nn.LeakyReLU(0.01)]
+            if pool:
+                mods.append(nn.MaxPool2d(kernel_size=2, stride=2))
+            return nn.Sequential(*mods)
+
+        self.block1 = block(convs[0:3], True)
+        self.block2 = block(convs[3:6], True)
+        self.block3 = block(convs[6:9], False)
+        self.fc = copy.deepcopy(model.l_c1)
+
+    def forward(self, x):
+        h = self.block3(self.block2(self.block1(x)))
+        h = F.adaptive_avg_pool2d(h, 1).flatten(1)
+        return F.log_softmax(self.fc(h), dim=1)
+
+
+class FusedMNIST(nn.Module):
+    """MNIST_CNN in eval mode (no BatchNorm to fold, dropout removed)."""
+
+    def __init__(self, model):
+        super(FusedMNIST, self).__init__()
+        self.conv1 = copy.deepcopy(model.conv1)
+        self.conv2 = copy.deepcopy(model.conv2)
+        self.fc1 = copy.deepcopy(model.fc1)
+        self.fc2 = copy.deepcopy(model.fc2)
+
+    def forward(self, x):
+        x = F.relu(F.max_pool2d(self.conv1(x), 2))
+        x = F.relu(F.max_pool2d(self.conv2(x), 2))
+        x = F.relu(self.fc1(x.flatten(1)))
+        return F.log_softmax(self.fc2(x), dim=1)
+
+
+def fuse(model):
+    """Inference-only float copy of a CIFAR10_CNN or MNIST_CNN."""
+    from dataclean import CIFAR10_CNN, MNIST_CNN
+
+    model = copy.deepcopy(model).cpu().eval()
+    if isinstance(model, CIFAR10_CNN):
+        return FusedCIFAR10(model).eval()
+    if isinstance(model, MNIST_CNN):
+        return FusedMNIST(model).eval()
+    raise TypeError('cannot export {}'.format(type(model).__name__))
+
+
+def export(model, example, quantize=None, channels_last=True):
+    """Fused, optionally int8-quantized, frozen TorchScript module.
+
+    Parameters
+    ----------
+    model: CIFAR10_CNN or MNIST_CNN
+    example: torch.Tensor
+        input batch used for tracing and, with quantize='static', for
+        calibrating the activation ranges
+    quantize: {None, 'dynamic', 'static'}
+    channels_last: bool
+
+    Returns
+    -------
+    torch.jit.ScriptModule returning log probabilities like the model
+    """
+    if quantize not in QUANTIZE:
+        raise ValueError("quantize must be None, 'dynamic' or 'static'.")
+    m = fuse(model)
+    example = example.detach().cpu().float()
+    if channels_last:
+        m = m.to(memory_format=torch.channels_last)
+        example = example.contiguous(memory_format=torch.channels_last)
+    if quantize == 'dynamic':
+        m = torch.ao.quantization.quantize_dynamic(m, {nn.Linear}, dtype=torch.qint8)
+    elif quantize == 'static':
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+        qconfig = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        m = prepare_fx(m, qconfig, (example,))
+        with torch.no_grad():
+            m(example)
+        m = convert_fx(m)
+    with torch.no_grad(), warnings.catch_warnings():
+        # newer torch flags TorchScript as deprecated, it still runs fine
+        warnings.simplefilter('ignore', FutureWarning)
+        scripted = torch.jit.freeze(torch.jit.trace(m, example).eval())
+    return scripted
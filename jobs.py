@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""后台任务 -- background queue for long-running audits started from the web app.
+
+Job state lives in one json file written through ResultStore, so every app
+worker process sees the same jobs and an identical submission is found no
+matter which worker receives it. Jobs execute on a thread pool of the worker
+that accepted them; stage progress comes from the profiling spans the job
+opens (see profiling.py).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from profiling import PROFILER
+from result_store import ResultStore
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+def _jsonable(obj):
+    if hasattr(obj, 'tolist'):  # numpy arrays and scalars
+        return obj.tolist()
+    return str(obj)
+
+
+def _alive(pid):
+    if os.name == 'nt':  # os.kill would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue(object):
+    """Deduplicating job queue.
+
+    The job id is a hash of the params, so submitting params identical to a
+    queued, running or finished job returns that job instead of starting a
+    new one. Failed jobs and jobs whose worker process died are run again.
+
+    Parameters
+    ----------
+    state_path: str
+        json file holding every job record
+    target: callable
+        ``target(params)`` runs one job, its json-serializable return value
+        is kept as the job result
+    max_workers: int
+        jobs running at once in this process
+    """
+
+    def __init__(self, state_path, target, max_workers=1):
+        self.store = ResultStore(state_path)
+        self.target = target
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._active = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def job_id(params):
+        blob = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()[:16]
+
+    def submit(self, params):
+        """Queue a job for ``params``; returns ``(record, created)``."""
+        job_id = self.job_id(params)
+        with self.store.modify() as jobs:
+            record = jobs.get(job_id)
+            if record is not None and record['status'] != FAILED and not self._lost(record):
+                return record, False
+            record = jobs[job_id] = {
+                'id': job_id,
+                'params': params,
+                'status': QUEUED,
+                'pid': os.getpid(),
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'stage': None,
+                'stages': [],
+                'result': None,
+                'error': None,
+            }
+            with self._lock:
+                self._active.add(job_id)
+        self._pool.submit(self._run, job_id, params)
+        return record, True
+
+    def get(self, job_id):
+        """Job record or None; a job whose process died reads as failed."""
+        record = self.store.read().get(job_id)
+        if record is not None and self._lost(record):
+            record = dict(record, status=FAILED, error='worker process exited')
+        return record
+
+    def jobs(self):
+        return self.store.read()
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _lost(self, record):
+        if record['status'] not in (QUEUED, RUNNING):
+            return False
+        if record['pid'] == os.getpid():
+            with self._lock:
+                return record['id'] not in self._active
+        return not _alive(record['pid'])
+
+    def _update(self, job_id, **values):
+        values = json.loads(json.dumps(values, default=_jsonable))
+        with self.store.modify() as jobs:
+            jobs[job_id].update(values)
+
+    def _on_span(self, job_id, span, finished):
+        if not finished:
+            self._update(job_id, stage=span.name)
+            return
+        with self.store.modify() as jobs:
+            record = jobs[job_id]
+            record['stages'].append({'name': span.name, 'parent': span.parent, 'wall_s': span.wall})
+            record['stage'] = span.parent
+
+    def _run(self, job_id, params):
+        self._update(job_id, status=RUNNING, started=time.time())
+        try:
+            listener = lambda span, finished: self._on_span(job_id, span, finished)
+            with PROFILER.collect(listener=listener):
+                result = self.target(params)
+        except Exception as e:
+            self._update(job_id, status=FAILED, error=repr(e), stage=None, finished=time.time())
+        else:
+            self._update(job_id, status=DONE, result=result, stage=None, finished=time.time())
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""响应编码 -- JSON / typed binary encodings and compression for /data.
+
+Binary layout (little endian)::
+
+    b'FIHM' | uint32 header length | header json | pad | array 0 | pad | array 1 ...
+
+The header is ``{"meta": {...}, "arrays": [{"name", "dtype", "shape",
+"offset"}]}``; ``offset`` is counted from the start of the buffer and every
+array starts on an 8 byte boundary, so a browser can wrap it directly in a
+TypedArray (``dtype`` uses numpy's ``'<u1'``, ``'<i2'``, ... spelling).
+"""
+import gzip
+import json
+import struct
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+JSON_MIMETYPE = 'application/json'
+BINARY_MIMETYPE = 'application/x-heatmap'
+MAGIC = b'FIHM'
+ALIGN = 8
+# bodies smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _pad(n):
+    return (-n) % ALIGN
+
+
+def encode_json(meta, arrays):
+    body = dict(meta)
+    for name, arr in arrays.items():
+        body[name] = arr.tolist()
+    return json.dumps(body).encode('utf-8')
+
+
+def encode_binary(meta, arrays):
+    arrays = [(name, np.ascontiguousarray(arr)) for name, arr in arrays.items()]
+    for i, (name, arr) in enumerate(arrays):
+        if arr.dtype.itemsize == 8 and arr.dtype.kind in 'iu':
+            # no 64-bit int TypedArray without BigInt, heatmaps fit in 32 bits
+            arrays[i] = (name, arr.astype(arr.dtype.kind + '4'))
+    specs = [{'name': name, 'dtype': arr.dtype.newbyteorder('<').str, 'shape': list(arr.shape)}
+             for name, arr in arrays]
+    # offsets depend on the header length, which depends on the offsets;
+    # fixed-width offsets break the cycle
+    for spec in specs:
+        spec['offset'] = 0
+    header_len = len(json.dumps({'meta': meta, 'arrays': specs}).encode('utf-8')) + 16 * len(specs)
+    offset = 8 + header_len + _pad(8 + header_len)
+    for spec, (_, arr) in zip(specs, arrays):
+        spec['offset'] = offset
+        offset += arr.nbytes + _pad(arr.nbytes)
+    header = json.dumps({'meta': meta, 'arrays': specs}).encode('utf-8').ljust(header_len)
+    parts = [MAGIC, struct.pack('<I', header_len), header, b'\0' * _pad(8 + header_len)]
+    for _, arr in arrays:
+        parts.append(arr.astype(arr.dtype.newbyteorder('<'), copy=False).tobytes())
+        parts.append(b'\0' * _pad(arr.nbytes))
+    return b''.join(parts)
+
+
+def decode_binary(buf):
+    """Inverse of encode_binary, returns ``(meta, {name: array})``."""
+    if buf[:4] != MAGIC:
+        raise ValueError('not a heatmap payload')
+    header_len, = struct.unpack('<I', buf[4:8])
+    header = json.loads(buf[8:8 + header_len].decode('utf-8'))
+    arrays = {}
+    for spec in header['arrays']:
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'])) if spec['shape'] else 1
+        arrays[spec['name']] = np.frombuffer(buf, dtype=dtype, count=count,
+                                             offset=spec['offset']).reshape(spec['shape'])
+    return header['meta'], arrays
+
+
+def choose_encoding(accept_encodings):
+    """Pick a Content-Encoding from a werkzeug ``request.accept_encodings``."""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""性能剖析 -- named spans with wall time, CPU time and peak memory.
+
+    from profiling import PROFILER, span, timed
+
+    with span('cnn.fit'):
+        ...
+
+Finished spans are aggregated per name for the Prometheus ``/metrics``
+endpoint and, inside ``PROFILER.collect()``, also kept one by one for a
+per-run JSON report. While the profiler is disabled and the current thread
+is not collecting, ``span`` returns a shared no-op context manager.
+Set ``CYCLE_PROFILE=1`` in the environment to enable it at import.
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from snapshot import write_atomic
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def max_rss():
+    """Peak resident set size of the process in bytes, None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span(object):
+    """One timed stage.
+
+    ``cpu`` is process CPU time (torch worker threads included),
+    ``thread_cpu`` only the calling thread's. ``max_rss`` is the process
+    peak RSS when the span ends, ``rss_growth`` how much that peak rose
+    during the span.
+    """
+
+    __slots__ = ('profiler', 'name', 'parent', 'start', 'wall', 'cpu', 'thread_cpu', 'max_rss', 'rss_growth',
+                 '_c0', '_tc0', '_m0')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.parent = None
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        if stack:
+            self.parent = stack[-1].name
+        stack.append(self)
+        listener = getattr(self.profiler._local, 'listener', None)
+        if listener is not None:
+            listener(self, False)
+        self._m0 = max_rss()
+        self._c0 = time.process_time()
+        self._tc0 = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.start
+        self.thread_cpu = time.thread_time() - self._tc0
+        self.cpu = time.process_time() - self._c0
+        self.max_rss = max_rss()
+        self.rss_growth = None if self._m0 is None else self.max_rss - self._m0
+        self.profiler._stack().pop()
+        self.profiler._finish(self)
+        listener = getattr(self.profiler._local, 'listener', None)
+        if listener is not None:
+            listener(self, True)
+        return False
+
+    def to_dict(self, t0=0.0):
+        return OrderedDict([
+            ('name', self.name),
+            ('parent', self.parent),
+            ('start_s', self.start - t0),
+            ('wall_s', self.wall),
+            ('cpu_s', self.cpu),
+            ('thread_cpu_s', self.thread_cpu),
+            ('max_rss_bytes', self.max_rss),
+            ('rss_growth_bytes', self.rss_growth),
+        ])
+
+
+class Profiler(object):
+    """Span factory and per-name aggregate.
+
+    Parameters
+    ----------
+    enabled: bool
+        time every span; when False only threads inside ``collect()`` do
+    """
+
+    # aggregate columns: count, wall, cpu, max_rss
+    _METRICS = (
+        ('spans_total', 'counter', 'Finished spans.', 0),
+        ('span_wall_seconds_total', 'counter', 'Wall time spent in spans.', 1),
+        ('span_cpu_seconds_total', 'counter', 'Process CPU time spent in spans.', 2),
+        ('span_max_rss_bytes', 'gauge', 'Largest process peak RSS seen at the end of a span.', 3),
+    )
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = OrderedDict()
+        self._collecting = 0  # threads inside collect(), spares the thread-local lookup
+
+    def span(self, name):
+        """Context manager timing the block as ``name``."""
+        if not (self.enabled or self._collecting and getattr(self._local, 'records', None) is not None):
+            return _NO_SPAN
+        return Span(self, name)
+
+    def timed(self, name):
+        """Decorator running the function inside ``span(name)``."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def collect(self, active=True, listener=None):
+        """Keep every span finished in this thread; yields the span list
+        (None when not ``active``). ``listener(span, finished)`` is called
+        when a span of this thread starts and ends."""
+        if not active:
+            yield None
+            return
+        outer = getattr(self._local, 'records', None)
+        outer_listener = getattr(self._local, 'listener', None)
+        self._local.listener = listener
+        records = self._local.records = []
+        with self._lock:
+            self._collecting += 1
+        try:
+            yield records
+        finally:
+            with self._lock:
+                self._collecting -= 1
+            self._local.records = outer
+            self._local.listener = outer_listener
+            if outer is not None:
+                outer.extend(records)
+
+    def stats(self):
+        """``{name: (count, wall, cpu, max_rss)}`` since start or ``reset``."""
+        with self._lock:
+            return OrderedDict((name, tuple(s)) for name, s in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def prometheus(self, prefix='cycle'):
+        """Aggregates in the Prometheus text exposition format."""
+        stats = self.stats()
+        lines = []
+        for suffix, kind, doc, col in self._METRICS:
+            metric = '{}_{}'.format(prefix, suffix)
+            lines.append('# HELP {} {}'.format(metric, doc))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for name, values in stats.items():
+                if values[col] is not None:
+                    label = name.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append('{}{{span="{}"}} {}'.format(metric, label, values[col]))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def report(records, path=None, **meta):
+        """Per-run JSON of collected spans, written atomically to ``path``
+        when given; returns the report dict."""
+        t0 = min(s.start for s in records) if records else 0.0
+        out = OrderedDict([
+            ('meta', meta),
+            ('spans', [s.to_dict(t0) for s in sorted(records, key=lambda s: s.start)]),
+        ])
+        if path is not None:
+            write_atomic(path, json.dumps(out, indent=1, default=str).encode('utf-8'))
+        return out
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _finish(self, s):
+        records = getattr(self._local, 'records', None)
+        if records is not None:
+            records.append(s)
+        with self._lock:
+            agg = self._stats.get(s.name)
+            if agg is None:
+                agg = self._stats[s.name] = [0, 0.0, 0.0, None]
+            agg[0] += 1
+            agg[1] += s.wall
+            agg[2] += s.cpu
+            if s.max_rss is not None:
+                agg[3] = max(agg[3] or 0, s.max_rss)
+
+
+PROFILER = Profiler(enabled=os.environ.get('CYCLE_PROFILE', '') not in ('', '0'))
+span = PROFILER.span
+timed = PROFILER.timed
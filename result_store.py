@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""结果文件读写 -- locked, atomic read-modify-write of keti2.json."""
+import json
+from contextlib import contextmanager
+
+from snapshot import write_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive inter-process lock held on ``path`` (created if missing)."""
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ResultStore(object):
+    """keti2.json shared by several evaluation jobs.
+
+    Writers take ``<json_path>.lock``, re-read the file, change only what
+    they own and replace the file with an atomic rename, so concurrent jobs
+    writing different sections (abnormal_data, frame_test, env_test, ...)
+    never lose each other's updates and readers never see a partial file.
+
+    Parameters
+    ----------
+    json_path: str
+    """
+
+    def __init__(self, json_path):
+        self.json_path = json_path
+        self.lock_path = json_path + '.lock'
+
+    def read(self):
+        """Current content; needs no lock since writes are atomic renames."""
+        try:
+            with open(self.json_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @contextmanager
+    def modify(self):
+        """``with store.modify() as d:`` -- d is written back on exit."""
+        with file_lock(self.lock_path):
+            data = self.read()
+            yield data
+            self._write(data)
+
+    def set(self, path, value):
+        """Set one field, path is a key tuple or a dotted string."""
+        keys = path.split('.') if isinstance(path, str) else list(path)
+        with self.modify() as data:
+            node = data
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = value
+
+    def update(self, section, values):
+        """Merge the dict ``values`` into one top-level section."""
+        with self.modify() as data:
+            data.setdefault(section, {}).update(values)
+
+    def _write(self, data):
+        write_atomic(self.json_path, json.dumps(data).encode('utf-8'), fsync=True)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""结果快照 -- background, atomic snapshot files for /data responses."""
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# read once, setting the umask to query it is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_atomic(path, data, fsync=False):
+    """Write to ``path`` via a unique temp file in the same dir and os.replace.
+
+    ``data`` is bytes, or a callable that writes to the binary file object
+    it is given (e.g. ``lambda f: np.save(f, arr)``). With ``fsync`` the
+    content is on disk before the rename. The file keeps the mode of the
+    one it replaces, a new file gets the usual ``0o666 & ~umask`` instead
+    of mkstemp's 0600.
+    """
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        mode = 0o666 & ~_UMASK
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class SnapshotWriter(object):
+    """Writes snapshots off the request thread.
+
+    Each key gets its own file ``<out_dir>/<prefix>_<key>.json``; every write
+    goes through a unique temp file and an atomic rename, so concurrent writers
+    of the same key leave one complete file behind.
+
+    Parameters
+    ----------
+    out_dir: str
+    prefix: str
+    max_workers: int
+    """
+
+    def __init__(self, out_dir, prefix='inject', max_workers=1):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        os.makedirs(out_dir, exist_ok=True)
+
+    def path_for(self, *key):
+        name = '_'.join(str(k) for k in (self.prefix,) + key)
+        return os.path.join(self.out_dir, re.sub(r'[^\w.-]', '_', name) + '.json')
+
+    def submit(self, key, data):
+        """Queue ``data`` (str or bytes) for ``key``; returns a Future."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self._pool.submit(write_atomic, self.path_for(*key), data)
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""参数扫描 -- run_cleanlab over a grid of datasets, noise levels and seeds.
+
+    python sweep.py --datasets MNIST CIFAR10 --pert-nums 4 8 16 --seeds 0 1 2 \\
+        --cpu-budget 8 --out sweep.csv
+
+Each dataset is loaded once in this process; grid points run in forked
+workers that share it, ``cpu_budget // threads`` at a time. Identical points
+are served from the AuditCache. With ``share_pretrain`` one model per dataset
+is trained on the clean train split and every point fine-tunes from it
+instead of pre-training from scratch; the base model never sees the audited
+batch or its noisy labels. The result is one row per point in a CSV (or
+Parquet, needs pandas) table.
+"""
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from profiling import PROFILER
+
+COLUMNS = ('dataset', 'PERT_NUM', 'seed', 'audit_size', 'share_pretrain', 'fix_rate', 'cache_hit',
+           'wall_s', 'cpu_s', 'pretrain_s', 'cv_folds_s', 'latent_s', 'render_s', 'max_rss_bytes')
+
+# dataset -> (audit loader, base state dict or None), inherited by the forked workers
+_datasets = {}
+
+
+def load_dataset(name, root='./data', audit_size=64, share_pretrain=False, pretrain_size=2048,
+                 pretrain_epochs=10):
+    """Audit batch of ``name`` (the first audit_size test images) and, with
+    share_pretrain, a base model trained on the first pretrain_size
+    training images."""
+    from dataclean import CNN, _chunk_loader
+    from dataset_cache import CachedImageDataset
+
+    test = CachedImageDataset(name, root, train=False)
+    X, y = test[np.arange(min(audit_size, len(test)))]
+    base = None
+    if share_pretrain:
+        train = CachedImageDataset(name, root, train=True)
+        X_train, y_train = train[np.arange(min(pretrain_size, len(train)))]
+        cnn = CNN(epochs=pretrain_epochs, log_interval=None, train_loader=_chunk_loader(X_train, y_train),
+                  test_loader=None, test_size=len(y_train), dataset=name)
+        cnn.fit(np.arange(len(y_train)), y_train.numpy())
+        base = {k: v.detach().clone() for k, v in cnn.model.state_dict().items()}
+    _datasets[name] = (_chunk_loader(X, y, batch_size=len(y)), base)
+
+
+def _init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def run_point(dataset, pert_num, seed, out_dir, cache=None, render=False, finetune_epochs=2, max_images=32):
+    """One grid point; returns its result row."""
+    from dataclean import run_cleanlab
+
+    loader, base = _datasets[dataset]
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    with PROFILER.collect() as spans:
+        fix_rate = run_cleanlab(loader, loader, out_dir, dataset=dataset, PERT_NUM=pert_num,
+                                MAX_IMAGES=max_images, seed=seed, cache=cache, render=render,
+                                fig_name='label_errors_{}_{}_{}.png'.format(dataset, pert_num, seed),
+                                pretrain_epochs=10 if base is None else finetune_epochs, warm_start=base)
+    wall = {}
+    for s in spans:
+        wall[s.name] = wall.get(s.name, 0.0) + s.wall
+    return {
+        'dataset': dataset,
+        'PERT_NUM': pert_num,
+        'seed': seed,
+        'audit_size': len(loader.dataset),
+        'share_pretrain': base is not None,
+        'fix_rate': fix_rate,
+        'cache_hit': 'pretrain' not in wall,
+        'wall_s': time.perf_counter() - t0,
+        'cpu_s': time.process_time() - c0,
+        'pretrain_s': wall.get('pretrain', 0.0),
+        'cv_folds_s': wall.get('cv_folds', 0.0),
+        'latent_s': wall.get('estimate_latent', 0.0) + wall.get('get_noise_indices', 0.0),
+        'render_s': wall.get('render', 0.0),
+        'max_rss_bytes': max([s.max_rss for s in spans if s.max_rss is not None] or [None]),
+    }
+
+
+def write_table(rows, path):
+    """CSV, or Parquet when ``path`` ends with .parquet."""
+    if path.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows, columns=COLUMNS).to_parquet(path, index=False)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def sweep(datasets, pert_nums, seeds, out='sweep.csv', root='./data', out_dir='./keti2', audit_size=64,
+          cpu_budget=None, threads=1, cache='.audit_cache', share_pretrain=False, pretrain_size=2048,
+          finetune_epochs=2, render=False):
+    """Run every (dataset, PERT_NUM, seed) point and write the results table.
+
+    Parameters
+    ----------
+    datasets: list of {'MNIST', 'CIFAR10'}
+    pert_nums: list of int
+    seeds: list of int
+    out: str
+        results table, .csv or .parquet
+    cpu_budget: int, default=None
+        CPU cores to use, defaults to all of them
+    threads: int
+        torch threads per point; cpu_budget // threads points run at once
+    cache: str or None
+        AuditCache directory, None disables the cache
+    share_pretrain: bool
+        fine-tune every point from one model per dataset trained on the
+        clean train split instead of pre-training from scratch
+    finetune_epochs: int
+        pre-training epochs of a point when share_pretrain is set
+
+    Returns
+    -------
+    list of result rows (dicts with COLUMNS) in grid order
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for name in datasets:
+        load_dataset(name, root, audit_size, share_pretrain, pretrain_size)
+    grid = list(itertools.product(datasets, pert_nums, seeds))
+    args = [(name, pert_num, seed, out_dir, cache, render, finetune_epochs) for name, pert_num, seed in grid]
+
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    workers = max(1, min(len(grid), cpu_budget // max(1, threads)))
+    if workers == 1:
+        n_threads = torch.get_num_threads()
+        torch.set_num_threads(threads)
+        try:
+            rows = [run_point(*a) for a in args]
+        finally:
+            torch.set_num_threads(n_threads)
+    else:
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(threads,)) as pool:
+            rows = list(pool.map(run_point, *zip(*args)))
+    write_table(rows, out)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--datasets', nargs='+', default=['MNIST'], choices=['MNIST', 'CIFAR10'])
+    parser.add_argument('--pert-nums', type=int, nargs='+', default=[16])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--out', default='sweep.csv')
+    parser.add_argument('--root', default='./data')
+    parser.add_argument('--out-dir', default='./keti2')
+    parser.add_argument('--audit-size', type=int, default=64)
+    parser.add_argument('--cpu-budget', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--cache', default='.audit_cache')
+    parser.add_argument('--no-cache', dest='cache', action='store_const', const=None)
+    parser.add_argument('--share-pretrain', action='store_true')
+    parser.add_argument('--pretrain-size', type=int, default=2048)
+    parser.add_argument('--finetune-epochs', type=int, default=2)
+    parser.add_argument('--render', action='store_true')
+    args = parser.parse_args()
+    rows = sweep(args.datasets, args.pert_nums, args.seeds, out=args.out, root=args.root, out_dir=args.out_dir,
+                 audit_size=args.audit_size, cpu_budget=args.cpu_budget, threads=args.threads, cache=args.cache,
+                 share_pretrain=args.share_pretrain, pretrain_size=args.pretrain_size,
+                 finetune_epochs=args.finetune_epochs, render=args.render)
+    for row in rows:
+        print('{dataset:8} PERT_NUM={PERT_NUM:<4} seed={seed:<4} fix_rate={fix_rate:.3f} '
+              'wall={wall_s:.1f}s'.format(**row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""生产部署入口 -- WSGI entry point.
+
+    gunicorn -w 4 --preload -b 0.0.0.0:10080 wsgi:application
+
+``--preload`` imports this module once in the master process, so the FI
+indexes and mapped heatmaps are built before forking and shared read-only
+by every worker.
+"""
+from app import create_app
+
+application = create_app(preload_data=True, preload_heatmaps=True)